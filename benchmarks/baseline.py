@@ -0,0 +1,75 @@
+"""
+The Metric timer path as it was before the timers were cached, the path
+is built and looked up in the routes on every begin.  The benchmark times
+against it and the tests check the current path gives the same timers
+"""
+import time
+
+from graphdat.metric import Metric, Timer
+
+__all__ = ['BaselineMetric']
+
+
+class BaselineMetric(Metric):
+
+    def begin(self, name):
+        if name is None:
+            self.log("Timer can not be started, name is missing")
+            return
+
+        self._beginTimer(name)
+
+    def end(self, name):
+        if name is None:
+            self.log("Timer can not be ended, name is missing")
+            return
+
+        self._endTimer(name)
+
+    def _beginTimer(self, name):
+
+        separator = (self.current and self.current.path[-1] != '/') and '/' or ''
+        path = (self.current) and self.current.path + separator + name or name
+
+        depth = path.count('/')
+        if (depth > self.MAXIMUM_DEPTH):
+            # sometimes some code ends up in a recursive loop, lets not create timers for each one of those accidents
+            self.error("The timer stack is too deep.  The current hierarchy is %d levels deep, maximum depth is %d", (depth, self.MAXIMUM_DEPTH))
+            return
+
+        self.log("Starting timer for path %s" % path)
+
+        # if we have a route for this, get it, otherwise create a new one
+        if path in self.routes:
+            timer = self.routes[path]
+        else:
+            offset = time.time() - self.requestStart
+            timer = Timer(name, offset, path, self.current)
+            self.routes[path] = timer
+            if (self.current):
+                self.current.children.append(timer)
+
+        # increment the counter and reset the timer in case we have the same
+        # path twice, otherwise the numbers will get skewed
+        timer.callcount += 1
+        timer.lastTimerStart = time.time()
+        self.current = timer
+
+    def _endTimer(self, name):
+
+        if len(self.routes) == 0:
+            self.log('timers :: trying to end timer %s when there are no timers' % name)
+            return False
+        if self.current is None:
+            self.log('timers :: trying to end timer %s when current is none' % name)
+            return False
+        if self.current.name != name:
+            self.log('timers :: could not end timer %s because it is not the last timer to begin' % name)
+            return False
+
+        duration = (time.time() - self.current.lastTimerStart) * 1000  # need it in milliseconds
+        self.current.responseTime += duration
+
+        self.log("Ending timer for path %s" % self.current.path)
+        self.current = self.current.parent
+        return True
@@ -0,0 +1,58 @@
+"""
+Time the overhead of a hooked call outside a request, and of a timed
+call inside a request
+
+    python benchmarks/bench_instrument.py
+"""
+import os
+import sys
+import thread
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from graphdat.instrument import _active, instrument
+from graphdat.metric import Metric
+
+CALLS = 100000
+
+
+def _noop(*args, **kwargs):
+    pass
+
+
+class Plain(object):
+    def execute(self):
+        pass
+
+
+class Hooked(object):
+    def execute(self):
+        pass
+
+
+def best(func):
+    return min(timeit.repeat(func, number=CALLS, repeat=5)) / CALLS * 1000000
+
+
+def main():
+    instrument(Hooked, 'execute', 'execute')
+
+    plain = best(Plain().execute)
+    outside = best(Hooked().execute)
+
+    # a request with a budget large enough to time every call
+    metric = Metric({}, [], _noop, _noop)
+    _active[thread.get_ident()] = [metric, CALLS * 10]
+    try:
+        inside = best(Hooked().execute)
+    finally:
+        del _active[thread.get_ident()]
+
+    print 'plain call              %6.3fus' % plain
+    print 'hooked, not in request  %6.3fus (+%.3fus)' % (outside, outside - plain)
+    print 'hooked, in a request    %6.3fus (+%.3fus)' % (inside, inside - plain)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Time the Metric begin/end path against the baseline that builds the path
+on every begin, with and without the C speedups
+
+    python setup.py build_ext --inplace
+    python benchmarks/bench_metric.py
+
+The variants are timed in turns so a busy machine slows them all down
+alike, the best and the median of the rounds are shown
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks.baseline import BaselineMetric
+from graphdat import metric
+from graphdat.metric import Metric
+
+# the number of rows in the per row timer loop
+ROWS = 200
+# how many requests we time in a round
+REQUESTS = 50
+# how many rounds we time each variant
+ROUNDS = 20
+
+
+def _noop(*args, **kwargs):
+    pass
+
+
+def request(metricClass):
+    sample = metricClass({}, [], _noop, _noop)
+    for i in range(ROWS):
+        sample.begin('orm')
+        sample.begin('row')
+        sample.end('row')
+        sample.begin('fetch')
+        sample.end('fetch')
+        sample.end('orm')
+    return sample.compile()
+
+
+def variant(metricClass, speedups):
+    def run():
+        metric._speedups = speedups
+        return timeit.timeit(lambda: request(metricClass), number=REQUESTS)
+    return run
+
+
+def main():
+    speedups = metric._speedups
+    variants = [('baseline', variant(BaselineMetric, None)),
+                ('python', variant(Metric, None))]
+    if speedups is not None:
+        variants.append(('c', variant(Metric, speedups)))
+    else:
+        print 'the C speedups are not built, see the docstring'
+
+    times = dict((name, []) for name, run in variants)
+    for i in range(ROUNDS):
+        for name, run in variants:
+            times[name].append(run() / REQUESTS * 1000)
+    metric._speedups = speedups
+
+    baseline = min(times['baseline'])
+    print '%-10s %10s %10s %8s  (%d timers per request)' % ('', 'best', 'median', 'speedup', ROWS * 6)
+    for name, run in variants:
+        best = min(times[name])
+        median = sorted(times[name])[ROUNDS // 2]
+        print '%-10s %8.3fms %8.3fms %7.2fx' % (name, best, median, baseline / best)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Time the import of graphdat, the wrapping of an application and the
+first request, and check that nothing is started before the first request
+
+    python benchmarks/bench_startup.py
+
+Run it in a fresh process, the import is only timed once
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# the modules that should only be loaded by the first request
+DEFERRED_MODULES = ('graphdat.agent', 'msgpack', 'logging', 'socket', 'struct')
+
+
+def application(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['ok']
+
+
+def main():
+    threads = threading.active_count()
+    loaded = [name for name in DEFERRED_MODULES if name in sys.modules]
+
+    start = time.time()
+    import graphdat
+    imported = time.time()
+    wrapped = graphdat.WSGIWrapper(application, {'socketFile': '/tmp/graphdat-bench.sock'})
+    ready = time.time()
+
+    # nothing is started before the first request
+    startedThreads = threading.active_count() - threads
+    startedModules = [name for name in DEFERRED_MODULES
+                      if name in sys.modules and name not in loaded]
+
+    environ = {
+        'HTTP_HOST': 'localhost',
+        'PATH_INFO': '/',
+        'QUERY_STRING': '',
+        'REQUEST_METHOD': 'GET',
+    }
+    result = wrapped(environ, lambda status, headers, exc_info=None: None)
+    list(result)
+    result.close()
+    firstRequest = time.time()
+
+    print 'import        %8.2fms' % ((imported - start) * 1000)
+    print 'wrap          %8.2fms' % ((ready - imported) * 1000)
+    print 'first request %8.2fms' % ((firstRequest - ready) * 1000)
+    print 'threads       %d before the first request, %d after' % (
+        threads + startedThreads, threading.active_count())
+
+    if startedThreads or startedModules:
+        print 'FAILED: started before the first request: %d threads, modules %s' % (
+            startedThreads, ', '.join(startedModules) or 'none')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+/*
+ * The optional C version of the Metric begin/end timer path
+ *
+ * A request with per row timers calls begin and end thousands of times,
+ * almost always for a timer it has already created.  beginTimer only
+ * handles a timer that is cached on its parent (or in the routes for the
+ * root) and returns False otherwise, so the Metric creates the timer in
+ * Python.  endTimer is the whole of Metric._endTimer.  Both do exactly
+ * what the Python versions do, including the calls to the logger.
+ *
+ * If this module can not be built, graphdat uses the Python versions.
+ */
+#include <Python.h>
+
+static PyObject *time_time = NULL;
+static PyObject *thousand = NULL;
+static PyObject *one = NULL;
+
+static PyObject *s_callcount = NULL;
+static PyObject *s_childrenByName = NULL;
+static PyObject *s_current = NULL;
+static PyObject *s_lastTimerStart = NULL;
+static PyObject *s_log = NULL;
+static PyObject *s_name = NULL;
+static PyObject *s_parent = NULL;
+static PyObject *s_path = NULL;
+static PyObject *s_responseTime = NULL;
+static PyObject *s_routes = NULL;
+
+/* call metric.log(message, value), returns -1 on failure */
+static int
+log_message(PyObject *metric, const char *message, PyObject *value)
+{
+    PyObject *log, *result;
+
+    log = PyObject_GetAttr(metric, s_log);
+    if (log == NULL)
+        return -1;
+    result = PyObject_CallFunction(log, "sO", message, value);
+    Py_DECREF(log);
+    if (result == NULL)
+        return -1;
+    Py_DECREF(result);
+    return 0;
+}
+
+/* timer.attribute += value, returns -1 on failure */
+static int
+add_to(PyObject *timer, PyObject *attribute, PyObject *value)
+{
+    PyObject *before, *after;
+    int status;
+
+    before = PyObject_GetAttr(timer, attribute);
+    if (before == NULL)
+        return -1;
+    after = PyNumber_InPlaceAdd(before, value);
+    Py_DECREF(before);
+    if (after == NULL)
+        return -1;
+    status = PyObject_SetAttr(timer, attribute, after);
+    Py_DECREF(after);
+    return status;
+}
+
+PyDoc_STRVAR(beginTimer_doc,
+"beginTimer(metric, name) -> bool\n\n\
+Begin a timer that is cached on the current timer, returns False without\n\
+doing anything when the timer has to be created.");
+
+static PyObject *
+beginTimer(PyObject *self, PyObject *args)
+{
+    PyObject *metric, *name;
+    PyObject *now = NULL, *current = NULL, *cache = NULL, *timer = NULL;
+    PyObject *path = NULL, *result = NULL;
+
+    if (!PyArg_ParseTuple(args, "OO:beginTimer", &metric, &name))
+        return NULL;
+
+    now = PyObject_CallObject(time_time, NULL);
+    if (now == NULL)
+        goto done;
+
+    current = PyObject_GetAttr(metric, s_current);
+    if (current == NULL)
+        goto done;
+    if (current == Py_None)
+        cache = PyObject_GetAttr(metric, s_routes);
+    else
+        cache = PyObject_GetAttr(current, s_childrenByName);
+    if (cache == NULL)
+        goto done;
+
+    /* a missing timer, or anything unusual, is left to the python path */
+    if (!PyDict_CheckExact(cache) || (timer = PyDict_GetItem(cache, name)) == NULL) {
+        PyErr_Clear();
+        result = Py_False;
+        Py_INCREF(result);
+        goto done;
+    }
+    Py_INCREF(timer);
+
+    path = PyObject_GetAttr(timer, s_path);
+    if (path == NULL || log_message(metric, "Starting timer for path %s", path) < 0)
+        goto done;
+
+    if (add_to(timer, s_callcount, one) < 0)
+        goto done;
+    if (PyObject_SetAttr(timer, s_lastTimerStart, now) < 0)
+        goto done;
+    if (PyObject_SetAttr(metric, s_current, timer) < 0)
+        goto done;
+
+    result = Py_True;
+    Py_INCREF(result);
+
+done:
+    Py_XDECREF(now);
+    Py_XDECREF(current);
+    Py_XDECREF(cache);
+    Py_XDECREF(timer);
+    Py_XDECREF(path);
+    return result;
+}
+
+PyDoc_STRVAR(endTimer_doc,
+"endTimer(metric, name) -> bool\n\n\
+End the current timer if it has the name, the same as Metric._endTimer.");
+
+static PyObject *
+endTimer(PyObject *self, PyObject *args)
+{
+    PyObject *metric, *name;
+    PyObject *routes = NULL, *current = NULL, *currentName = NULL;
+    PyObject *now = NULL, *start = NULL, *elapsed = NULL, *duration = NULL;
+    PyObject *path = NULL, *parent = NULL, *result = NULL;
+    int status;
+
+    if (!PyArg_ParseTuple(args, "OO:endTimer", &metric, &name))
+        return NULL;
+
+    routes = PyObject_GetAttr(metric, s_routes);
+    if (routes == NULL)
+        goto done;
+    current = PyObject_GetAttr(metric, s_current);
+    if (current == NULL)
+        goto done;
+
+    status = PyObject_IsTrue(routes);
+    if (status < 0)
+        goto done;
+    if (!status) {
+        if (log_message(metric, "timers :: trying to end timer %s when there are no timers", name) < 0)
+            goto done;
+        result = Py_False;
+        Py_INCREF(result);
+        goto done;
+    }
+    if (current == Py_None) {
+        if (log_message(metric, "timers :: trying to end timer %s when current is none", name) < 0)
+            goto done;
+        result = Py_False;
+        Py_INCREF(result);
+        goto done;
+    }
+
+    currentName = PyObject_GetAttr(current, s_name);
+    if (currentName == NULL)
+        goto done;
+    status = PyObject_RichCompareBool(currentName, name, Py_NE);
+    if (status < 0)
+        goto done;
+    if (status) {
+        if (log_message(metric, "timers :: could not end timer %s because it is not the last timer to begin", name) < 0)
+            goto done;
+        result = Py_False;
+        Py_INCREF(result);
+        goto done;
+    }
+
+    /* need it in milliseconds */
+    now = PyObject_CallObject(time_time, NULL);
+    if (now == NULL)
+        goto done;
+    start = PyObject_GetAttr(current, s_lastTimerStart);
+    if (start == NULL)
+        goto done;
+    elapsed = PyNumber_Subtract(now, start);
+    if (elapsed == NULL)
+        goto done;
+    duration = PyNumber_Multiply(elapsed, thousand);
+    if (duration == NULL)
+        goto done;
+    if (add_to(current, s_responseTime, duration) < 0)
+        goto done;
+
+    path = PyObject_GetAttr(current, s_path);
+    if (path == NULL || log_message(metric, "Ending timer for path %s", path) < 0)
+        goto done;
+
+    parent = PyObject_GetAttr(current, s_parent);
+    if (parent == NULL)
+        goto done;
+    if (PyObject_SetAttr(metric, s_current, parent) < 0)
+        goto done;
+
+    result = Py_True;
+    Py_INCREF(result);
+
+done:
+    Py_XDECREF(routes);
+    Py_XDECREF(current);
+    Py_XDECREF(currentName);
+    Py_XDECREF(now);
+    Py_XDECREF(start);
+    Py_XDECREF(elapsed);
+    Py_XDECREF(duration);
+    Py_XDECREF(path);
+    Py_XDECREF(parent);
+    return result;
+}
+
+static PyMethodDef speedups_methods[] = {
+    {"beginTimer", beginTimer, METH_VARARGS, beginTimer_doc},
+    {"endTimer", endTimer, METH_VARARGS, endTimer_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+#define INTERN(variable, value) \
+    if ((variable = PyString_InternFromString(value)) == NULL) return;
+
+PyMODINIT_FUNC
+init_speedups(void)
+{
+    PyObject *module, *time;
+
+    INTERN(s_callcount, "callcount");
+    INTERN(s_childrenByName, "childrenByName");
+    INTERN(s_current, "current");
+    INTERN(s_lastTimerStart, "lastTimerStart");
+    INTERN(s_log, "log");
+    INTERN(s_name, "name");
+    INTERN(s_parent, "parent");
+    INTERN(s_path, "path");
+    INTERN(s_responseTime, "responseTime");
+    INTERN(s_routes, "routes");
+
+    if ((thousand = PyInt_FromLong(1000)) == NULL)
+        return;
+    if ((one = PyInt_FromLong(1)) == NULL)
+        return;
+
+    /* the same clock as the python path */
+    time = PyImport_ImportModule("time");
+    if (time == NULL)
+        return;
+    time_time = PyObject_GetAttrString(time, "time");
+    Py_DECREF(time);
+    if (time_time == NULL)
+        return;
+
+    module = Py_InitModule3("_speedups", speedups_methods,
+                            "The optional C version of the Metric timer path");
+    if (module == NULL)
+        return;
+}
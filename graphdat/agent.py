@@ -1,13 +1,16 @@
+import os
 import socket
 import struct
 import sys
 import time
 import threading
-from Queue import Queue
+from collections import deque
 from msgpack import (
     packb as packs,
     unpackb as unpacks
 )
+from aggregate import Aggregator
+from shutdown import exiting
 
 __all__ = ['Agent']
 
@@ -18,15 +21,22 @@ class Agent(object):
     Validate and package the metrics for graphdat
     """
 
-    # if the queue gets larger than this, stop adding metrics instead of blocking
-    MAX_QUEUE_SIZE = 100
+    # if the queue gets larger than this, the overflow policy decides
+    # what happens to the next metric
+    MAX_QUEUE_SIZE = 1000
 
     # The queue will hold all of the messages to be sent to graphdat
-    _queue = Queue()
+    _queue = None
+
+    # The per route summaries of the requests, errors and successes
+    _aggregator = Aggregator()
 
     # The background worker push the data to graphdat
     _backgroundWorker = None
 
+    # The process the queue belongs to
+    _pid = os.getpid()
+
     def __init__(self, graphdat):
 
         if graphdat is None:
@@ -35,9 +45,39 @@ class Agent(object):
         self.graphdat = graphdat
         self.log = self.graphdat.log
 
+        # a forked worker can not share the queue of its parent, its locks
+        # may have been held by one of the parent threads when we forked
+        if Agent._queue is None or Agent._pid != os.getpid():
+            Agent._queue = _LaneQueue()
+            Agent._aggregator = Aggregator()
+            Agent._pid = os.getpid()
+
+        # how much we buffer and what we do when the buffer is full, a
+        # timeout of 0 drops the sample straight away with the block policy
+        queueTimeout = self.graphdat.queueTimeout
+        if queueTimeout is None:
+            queueTimeout = _LaneQueue.BLOCK_TIMEOUT
+        priorityQueueSize = self.graphdat.priorityQueueSize
+        if priorityQueueSize is None:
+            priorityQueueSize = _LaneQueue.MAX_PRIORITY_SIZE
+        self._queue.configure(self.graphdat.queueSize or self.MAX_QUEUE_SIZE,
+                              self.graphdat.queueBytes,
+                              self.graphdat.overflow or _LaneQueue.DROP_NEWEST,
+                              queueTimeout,
+                              priorityQueueSize)
+
+        # in exemplar mode only the slowest samples are kept
+        if self.graphdat.exemplars:
+            exemplarCount = self.graphdat.exemplarCount
+            if exemplarCount is None:
+                exemplarCount = Aggregator.EXEMPLAR_COUNT
+            self._aggregator.configure(exemplarCount,
+                                       self.graphdat.slowThreshold,
+                                       self.graphdat.slowRoutes)
+
         # create the background worker thread if it is not running already
         if not self._backgroundWorker or not self._backgroundWorker.isAlive():
-            self._backgroundWorker = _SendToGraphdat(self.graphdat, self._queue)
+            self._backgroundWorker = _SendToGraphdat(self.graphdat, self._queue, self._aggregator)
             self._backgroundWorker.daemon = True
             self._backgroundWorker.start()
 
@@ -68,9 +108,176 @@ class Agent(object):
                 self.log("graphdat could not get a the route from the trace")
                 continue
 
-            # send the metric to the queue as long as we have room
-            if self._queue.qsize() < self.MAX_QUEUE_SIZE:
-                self._queue.put(metric)
+            # with summaries every request counts towards the summary of its
+            # route, in exemplar mode only the slow requests and errors are
+            # sent on their own and the slowest of the rest are sent with
+            # the summary
+            if self.graphdat.exemplars:
+                if not metric.error and not self._aggregator.isSlow(metric):
+                    self._aggregator.add(metric, keepExemplar=True)
+                    continue
+                metric.type = 'Exemplar'
+            if self.graphdat.summaries:
+                self._aggregator.add(metric)
+
+            # errors and exemplars go in the priority lane so they are not
+            # starved by the routine samples
+            priority = bool(metric.error) or metric.type == 'Exemplar'
+
+            # when the buffer is limited in bytes we need the size of the
+            # message, we pack it here and the sender does not pack it again
+            if self._queue.maxBytes:
+                message = packs(metric)
+                size = len(message)
+            else:
+                message = metric
+                size = 0
+
+            # send the metric to the queue as long as we have room, otherwise
+            # its timers can be merged into the summary of its route
+            if not self._queue.put(message, size, priority):
+                if self._queue.policy == _LaneQueue.MERGE:
+                    self._aggregator.merge(metric)
+
+
+# the heartbeat goes through the queue, so it is sent
+# by the same thread as the messages
+_HEARTBEAT = object()
+
+
+class _LaneQueue(object):
+
+    """
+    The messages waiting to be sent to graphdat
+
+    Errors and exemplars go in the priority lane and are always sent first,
+    the routine samples go in the other lane.  A heartbeat has a slot of its
+    own and is sent before both, so it is never dropped.  The routine lane is
+    limited by the number of messages and optionally by their size in bytes,
+    once it is full the overflow policy decides what happens:
+
+    drop-newest  the new message is dropped
+    drop-oldest  the oldest messages are dropped to make room
+    merge        the new message is dropped and its timers are merged into
+                 the summary of its route
+    block        wait for room up to the timeout, then drop the new message
+    """
+
+    DROP_NEWEST = 'drop-newest'
+    DROP_OLDEST = 'drop-oldest'
+    MERGE = 'merge'
+    BLOCK = 'block'
+
+    # how long to wait for room with the block policy, in seconds
+    BLOCK_TIMEOUT = 0.1
+    # the priority lane only holds the rare messages, it never blocks
+    MAX_PRIORITY_SIZE = 100
+
+    def __init__(self):
+        self.maxSize = Agent.MAX_QUEUE_SIZE
+        self.maxBytes = None
+        self.policy = self.DROP_NEWEST
+        self.timeout = self.BLOCK_TIMEOUT
+        self.maxPrioritySize = self.MAX_PRIORITY_SIZE
+
+        # the lanes hold (message, size) pairs
+        self.priority = deque()
+        self.routine = deque()
+        self.routineBytes = 0
+        # only one heartbeat is ever waiting to be sent
+        self.heartbeat = False
+
+        lock = threading.Lock()
+        self.notEmpty = threading.Condition(lock)
+        self.notFull = threading.Condition(lock)
+
+    def configure(self, maxSize, maxBytes=None, policy=DROP_NEWEST, timeout=BLOCK_TIMEOUT,
+                  maxPrioritySize=MAX_PRIORITY_SIZE):
+        self.maxSize = maxSize
+        self.maxBytes = maxBytes
+        self.policy = policy
+        self.timeout = timeout
+        self.maxPrioritySize = maxPrioritySize
+
+    def put(self, message, size=0, priority=False):
+        """
+        Add the message to its lane, returns False if it was dropped
+        """
+        self.notFull.acquire()
+        try:
+            if priority:
+                if len(self.priority) >= self.maxPrioritySize:
+                    return False
+                self.priority.append((message, size))
+            else:
+                # a message larger than the lane can never fit, do not
+                # drop or wait for the queued messages because of it
+                if self.maxBytes and size > self.maxBytes:
+                    return False
+                if self._isFull(size) and not self._makeRoom(size):
+                    return False
+                self.routine.append((message, size))
+                self.routineBytes += size
+            self.notEmpty.notify()
+            return True
+        finally:
+            self.notFull.release()
+
+    def putHeartbeat(self):
+        """
+        Ask for a heartbeat to be sent, it is never dropped
+        """
+        self.notEmpty.acquire()
+        try:
+            self.heartbeat = True
+            self.notEmpty.notify()
+        finally:
+            self.notEmpty.release()
+
+    def get(self, timeout=None):
+        """
+        Get the next message, the heartbeat and the priority lane first,
+        or None if nothing arrived before the timeout.  Without a timeout
+        it waits until there is a message
+        """
+        self.notEmpty.acquire()
+        try:
+            if not self.heartbeat and not self.priority and not self.routine:
+                self.notEmpty.wait(timeout)
+            if self.heartbeat:
+                self.heartbeat = False
+                return _HEARTBEAT
+            if self.priority:
+                message, size = self.priority.popleft()
+            elif self.routine:
+                message, size = self.routine.popleft()
+                self.routineBytes -= size
+                self.notFull.notify()
+            else:
+                return None
+            return message
+        finally:
+            self.notEmpty.release()
+
+    def _isFull(self, size):
+        if len(self.routine) >= self.maxSize:
+            return True
+        return bool(self.maxBytes) and self.routineBytes + size > self.maxBytes
+
+    def _makeRoom(self, size):
+        # the lock is held by put
+        if self.policy == self.DROP_OLDEST:
+            while self.routine and self._isFull(size):
+                dropped, droppedSize = self.routine.popleft()
+                self.routineBytes -= droppedSize
+        elif self.policy == self.BLOCK:
+            deadline = time.time() + self.timeout
+            while self._isFull(size):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.notFull.wait(remaining)
+        return not self._isFull(size)
 
 
 class _SendToGraphdat(threading.Thread):
@@ -83,7 +290,7 @@ class _SendToGraphdat(threading.Thread):
      # The heartbeat worker keeps the file socket open
     _heartbeatWorker = None
 
-    def __init__(self, graphdat, queue):
+    def __init__(self, graphdat, queue, aggregator):
 
         threading.Thread.__init__(self)
 
@@ -103,9 +310,18 @@ class _SendToGraphdat(threading.Thread):
                 "the queue parameter should not be None")
         self.queue = queue
 
+        # the summaries to send once per interval
+        if aggregator is None:
+            raise TypeError(
+                "the aggregator parameter should not be None")
+        self.aggregator = aggregator
+
         # keep track of the last time we sent the data or a heartbeart
         self.lastSentData = time.time()
 
+        # set when the interpreter exits
+        self.exiting = exiting
+
         # how we talk to the graphdat agent
         if hasattr(self.graphdat, "socketFile"):
             self.transport = _FileSocket(self.graphdat)
@@ -120,28 +336,52 @@ class _SendToGraphdat(threading.Thread):
                 self._heartbeatWorker.start()
 
     def run(self):
-        while True:
-            # grab the next message
-            message = self.queue.get(block=True)
+        # the modules we use are torn down while the interpreter exits,
+        # stop quietly instead of failing with them
+        try:
+            while not self.exiting:
+                self._sendNext()
+        except:
+            # even the builtins are gone by then, catch everything
+            if not self.exiting:
+                raise
+
+    def _sendNext(self):
+        # grab the next message, only waking up for the summaries when the
+        # aggregator holds some, an idle sender just blocks on the queue
+        message = self.queue.get(self.aggregator.timeLeft())
+
+        if self.aggregator.due():
+            for summary in self.aggregator.flush():
+                self._send(summary)
 
-            # we have a message to send, the heart beat
-            # can take a break
-            self.lastSentData = time.time()
+        if message is None:
+            return
+
+        if message is _HEARTBEAT:
+            self.transport.sendHeartbeat()
+            return
+
+        self._send(message)
+
+    def _send(self, message):
+        # we have a message to send, the heart beat
+        # can take a break
+        self.lastSentData = time.time()
 
-            # msgpack it
+        # msgpack it, unless it was packed to measure its size
+        if not isinstance(message, str):
             message = packs(message)
 
-            # send the message
-            success = self.transport.send(message)
+        # send the message
+        success = self.transport.send(message)
 
-            # tell the queue we are done
-            self.queue.task_done()
+        if (success):
+            self.log("Message sent")
+            self.dump(unpacks(message, use_list=True))
+        else:
+            self.error("Sending metrics to Graphdat failed")
 
-            if (success):
-                self.log("Message sent")
-                self.dump(unpacks(message, use_list=True))
-            else:
-                self.error("Sending metrics to Graphdat failed")
 
 
 class _SendHeartbeat(threading.Thread):
@@ -158,15 +398,22 @@ class _SendHeartbeat(threading.Thread):
         self.sender = sender
         self.transport = transport
 
-    def run(self):
-        while True:
-            time.sleep(self.transport.heartbeatInterval)
-            now = time.time()
-            elapsed = now - self.sender.lastSentData
+        # set when the interpreter exits
+        self.exiting = exiting
 
-            if elapsed > self.transport.heartbeatInterval:
-                self.transport.sendHeartbeat()
-                self.sender.lastSentData = now
+    def run(self):
+        try:
+            while not self.exiting:
+                time.sleep(self.transport.heartbeatInterval)
+                now = time.time()
+                elapsed = now - self.sender.lastSentData
+
+                if elapsed > self.transport.heartbeatInterval:
+                    self.sender.queue.putHeartbeat()
+                    self.sender.lastSentData = now
+        except:
+            if not self.exiting:
+                raise
 
 
 class _FileSocket(object):
@@ -311,5 +558,5 @@ class _UDPSocket(object):
             self.sock.sendto(message, (self.host, self.port))
             return True
         except:
-            self.error("Unexpected error:", sys.exc_info()[0])
+            self.error("Unexpected error: %s", sys.exc_info()[0])
             return False
@@ -0,0 +1,216 @@
+import heapq
+import threading
+import time
+from dotdictionary import DotDictionary
+from metric import getPid
+
+__all__ = ['Aggregator']
+
+
+class Aggregator(object):
+
+    """
+    Keep a summary of the requests for each route
+
+    Slow errors and fast successes should not be averaged together, so
+    the error count and the latencies of each are kept separately and
+    sent to graphdat once per interval
+
+    In exemplar mode the samples are not sent on their own, instead the
+    slowest samples of each route are kept and sent with the summaries
+    """
+
+    # how often the summaries are sent to graphdat, in seconds
+    INTERVAL = 10
+    # how many of the slowest samples we keep for each route, per interval
+    EXEMPLAR_COUNT = 5
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.windowStart = time.time()
+        self.routes = {}
+        self._lock = threading.Lock()
+
+        # the exemplar settings, see configure
+        self.exemplarCount = self.EXEMPLAR_COUNT
+        self.slowThreshold = None
+        self.slowRoutes = {}
+
+    def configure(self, exemplarCount=EXEMPLAR_COUNT, slowThreshold=None, slowRoutes=None):
+        """
+        Set how many exemplars we keep per route and the response time
+        (in milliseconds) over which a sample is slow, for all routes
+        or for individual routes.  The routes are keyed as they are sent
+        to graphdat, a regex route has no leading slash, ex. the route
+        users/(?P<id>\d+) is {'GET users/:id': 250} and without a regex
+        route it is {'GET /users/42': 250}
+        """
+        self.exemplarCount = exemplarCount
+        self.slowThreshold = slowThreshold
+        self.slowRoutes = slowRoutes or {}
+
+    def isSlow(self, metric):
+        """
+        Is the sample over the slow threshold for its route
+        """
+        threshold = self.slowRoutes.get(metric.route, self.slowThreshold)
+        return threshold is not None and metric.responsetime >= threshold
+
+    def add(self, metric, keepExemplar=False):
+        """
+        Add a sample to the summary of its route, if keepExemplar is set
+        the sample is kept when it is one of the slowest of the interval
+        """
+        key = (metric.host, metric.route)
+        self._lock.acquire()
+        try:
+            # the interval starts with its first request
+            if not self.routes:
+                self.windowStart = time.time()
+            stats = self.routes.get(key)
+            if stats is None:
+                stats = self.routes[key] = RouteStats(metric.host, metric.route)
+            stats.add(metric)
+            if keepExemplar:
+                stats.keepExemplar(metric, self.exemplarCount)
+        finally:
+            self._lock.release()
+
+    def merge(self, metric):
+        """
+        Merge the timers of a sample that could not be sent on its own
+        into the summary of its route
+        """
+        key = (metric.host, metric.route)
+        self._lock.acquire()
+        try:
+            if not self.routes:
+                self.windowStart = time.time()
+            stats = self.routes.get(key)
+            if stats is None:
+                stats = self.routes[key] = RouteStats(metric.host, metric.route)
+            stats.merge(metric)
+        finally:
+            self._lock.release()
+
+    def timeLeft(self):
+        """
+        How long until the summaries are due in seconds, or None when
+        there are no summaries to send
+        """
+        if not self.routes:
+            return None
+        return max(self.windowStart + self.interval - time.time(), 0)
+
+    def due(self):
+        """
+        Is it time to send the summaries
+        """
+        return time.time() - self.windowStart >= self.interval
+
+    def flush(self):
+        """
+        Get the summaries for the interval and start a new one
+        """
+        self._lock.acquire()
+        try:
+            routes = self.routes
+            windowStart = self.windowStart
+            self.routes = {}
+            self.windowStart = time.time()
+        finally:
+            self._lock.release()
+
+        messages = []
+        for stats in routes.values():
+            messages.append(stats.compile(windowStart))
+            messages.extend(stats.compileExemplars())
+        return messages
+
+
+class RouteStats(object):
+
+    """
+    The summary of the requests for a single route
+    """
+
+    def __init__(self, host, route):
+        self.host = host
+        self.route = route
+        # successful requests and the time they took in milliseconds
+        self.count = 0
+        self.responseTime = 0
+        # failed requests and the time they took in milliseconds
+        self.errors = 0
+        self.errorResponseTime = 0
+        # a min heap of (responsetime, order, sample) of the slowest samples
+        self.exemplars = []
+        # the timers of the merged samples by their name
+        self.merged = 0
+        self.context = {}
+
+    def add(self, metric):
+        if metric.error:
+            self.errors += 1
+            self.errorResponseTime += metric.responsetime
+        else:
+            self.count += 1
+            self.responseTime += metric.responsetime
+
+    def merge(self, metric):
+        self.merged += 1
+        for timer in metric.context or ():
+            merged = self.context.get(timer.name)
+            if merged is None:
+                merged = self.context[timer.name] = DotDictionary({
+                    'callcount': 0,
+                    'name': timer.name,
+                    'responsetime': 0,
+                })
+            merged.callcount += timer.callcount
+            merged.responsetime += timer.responsetime
+
+    def keepExemplar(self, metric, count):
+        # the order breaks ties so the samples are never compared
+        entry = (metric.responsetime, self.count + self.errors, metric)
+        if len(self.exemplars) < count:
+            heapq.heappush(self.exemplars, entry)
+        elif self.exemplars and entry[0] > self.exemplars[0][0]:
+            heapq.heapreplace(self.exemplars, entry)
+
+    def compileExemplars(self):
+        """
+        The slowest samples, slowest first, with their full timer tree
+        """
+        exemplars = []
+        for entry in sorted(self.exemplars, reverse=True):
+            exemplar = entry[2]
+            exemplar.type = 'Exemplar'
+            exemplars.append(exemplar)
+        return exemplars
+
+    def compile(self, timestamp):
+        """
+        When we send the summary off to graphdat, we need the same
+        shape as the samples
+        """
+        # the response times are the totals of the interval, not the
+        # average, divide them by the counts
+        summary = DotDictionary({
+            'count': self.count,
+            'errorcount': self.errors,
+            'errortotalresponsetime': self.errorResponseTime,
+            'host': self.host,
+            'pid': getPid(),
+            'route': self.route,
+            'source': 'HTTP',
+            'timestamp': timestamp,
+            'totalresponsetime': self.responseTime,
+            'type': 'Summary',
+        })
+
+        # the timers of the samples we could not send
+        if self.merged:
+            summary.mergedcount = self.merged
+            summary.context = sorted(self.context.values(), key=lambda timer: timer.name)
+        return summary
@@ -0,0 +1,81 @@
+
+__all__ = ['StringCache', 'compileExtractors']
+
+# the headers the server puts in the environ without the HTTP_ prefix
+UNPREFIXED_HEADERS = ('CONTENT_TYPE', 'CONTENT_LENGTH')
+
+
+class StringCache(object):
+
+    """
+    A bounded cache of interned strings
+
+    The host and route of a request are rebuilt from the environ on
+    every request, but there are only a handful of distinct values, so
+    we build each one once and hand back the same string afterwards
+    """
+
+    # the number of strings we keep before starting again
+    MAX_SIZE = 1000
+
+    def __init__(self, maxSize=MAX_SIZE):
+        self.maxSize = maxSize
+        self._cache = {}
+
+    def get(self, key, build):
+        """
+        get the string for the key, building it if we have not seen it
+        """
+        value = self._cache.get(key)
+        if value is None:
+            value = build(key)
+            if type(value) is str:
+                value = intern(value)
+            # high cardinality routes (query strings without regex routes)
+            # should not grow the cache forever, just start again
+            if len(self._cache) >= self.maxSize:
+                self._cache.clear()
+            self._cache[key] = value
+        return value
+
+
+def compileExtractors(options):
+    """
+    Build the list of (tag, extractor) pairs from the options, each
+    extractor is called with the environ and returns the tag value or None
+
+    options.headers is a list of request header names, ex. ['User-Agent']
+    options.tags is a dictionary of tag names to a static value or a
+    callable that takes the environ
+    """
+    extractors = []
+    if not options:
+        return tuple(extractors)
+
+    # request headers live in the environ as HTTP_USER_AGENT, except for
+    # the content type and length
+    for header in options.get('headers') or ():
+        key = header.upper().replace('-', '_')
+        if key not in UNPREFIXED_HEADERS:
+            key = 'HTTP_' + key
+        extractors.append((header.lower(), _environGetter(key)))
+
+    for name, value in (options.get('tags') or {}).items():
+        if callable(value):
+            extractors.append((name, value))
+        else:
+            extractors.append((name, _constant(value)))
+
+    return tuple(extractors)
+
+
+def _environGetter(key):
+    def extract(environ):
+        return environ.get(key)
+    return extract
+
+
+def _constant(value):
+    def extract(environ):
+        return value
+    return extract
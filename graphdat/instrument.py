@@ -0,0 +1,281 @@
+import functools
+import os
+import sys
+import thread
+import threading
+import time
+
+from shutdown import exiting
+
+__all__ = ['Instrumentation', 'instrument']
+
+# the requests being instrumented, by thread, as [metric, timers left]
+_active = {}
+
+# the hooks we know about, (module, class, method, timer name)
+HOOKS = {
+    'sql': (
+        ('MySQLdb.cursors', 'BaseCursor', 'execute', 'sql execute'),
+        ('MySQLdb.cursors', 'BaseCursor', 'executemany', 'sql executemany'),
+        ('pymysql.cursors', 'Cursor', 'execute', 'sql execute'),
+        ('pymysql.cursors', 'Cursor', 'executemany', 'sql executemany'),
+    ),
+    'http': (
+        ('httplib', 'HTTPConnection', 'request', 'http request'),
+        ('httplib', 'HTTPConnection', 'getresponse', 'http response'),
+    ),
+    # recv and send are set on each socket, only the class methods can be hooked
+    'socket': (
+        ('socket', 'socket', 'connect', 'socket connect'),
+        ('socket', 'socket', 'sendall', 'socket sendall'),
+    ),
+    'templates': (
+        ('django.template.base', 'Template', 'render', 'template render'),
+        ('jinja2.environment', 'Template', 'render', 'template render'),
+        ('mako.template', 'Template', 'render', 'template render'),
+    ),
+}
+
+
+def instrument(owner, attribute, name):
+    """
+    Replace owner.attribute with a function that times every call as a
+    child timer of the current request, ex. instrument(Cursor, 'execute', 'sql')
+
+    Returns False if the attribute is missing or can not be replaced, C types
+    like the sqlite3 and psycopg2 cursors can not be patched, instrument the
+    class you wrap them with instead
+    """
+    func = getattr(owner, attribute, None)
+    if func is None:
+        return False
+    if getattr(func, '_graphdatTimer', None) is not None:
+        return True
+
+    def timed(*args, **kwargs):
+        active = _active.get(thread.get_ident())
+        # not in a request, or the request has used up its timers
+        if active is None or active[1] <= 0:
+            return func(*args, **kwargs)
+        active[1] -= 1
+        metric = active[0]
+        metric.begin(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metric.end(name)
+
+    try:
+        functools.update_wrapper(timed, func)
+    except AttributeError:
+        pass
+    timed._graphdatTimer = name
+
+    try:
+        setattr(owner, attribute, timed)
+    except (AttributeError, TypeError):
+        return False
+    return True
+
+
+class Instrumentation(object):
+
+    """
+    Automatically add timers for the database, http and template calls
+    of a request, and optionally sample where the request spends its time
+
+    options.instrument is True for all of the hooks or a list of their names,
+    options.instrumentBudget is the most timers the hooks add to a request,
+    options.sampler is True or the sample interval in milliseconds
+
+    We never import the hooked libraries ourselves, a hook is installed once
+    the application has imported its module, checked when wrapping the
+    application and at the start of a request when more modules have been
+    imported, until every hook is in
+    """
+
+    # the most timers the hooks add to a single request, after that the
+    # hooked calls run without a timer
+    TIMER_BUDGET = 500
+    # how often the sampler looks at the requests, in milliseconds
+    SAMPLE_INTERVAL = 10
+
+    # the sampler thread, one per process
+    _sampler = None
+
+    def __init__(self, options, graphdat):
+        self.log = graphdat.log
+        self.error = graphdat.error
+
+        self.budget = options.get('instrumentBudget')
+        if self.budget is None:
+            self.budget = self.TIMER_BUDGET
+
+        # the (module, class, method, timer name) hooks not installed yet,
+        # and the number of modules imported when we last looked for them
+        self._pending = []
+        self._modulesSeen = None
+        self._installLock = thread.allocate_lock()
+
+        hooks = options.get('instrument')
+        if hooks is True:
+            hooks = HOOKS.keys()
+        for hook in hooks or ():
+            if hook not in HOOKS:
+                raise ValueError(
+                    "the instrument option should only contain %s" % ', '.join(HOOKS))
+            self._pending.extend(HOOKS[hook])
+        self._install()
+
+        sampler = options.get('sampler')
+        if sampler is True:
+            sampler = self.SAMPLE_INTERVAL
+        self.sampleInterval = sampler and sampler / 1000.0 or None
+
+    def start(self, metric):
+        """
+        The request on this thread is using the metric
+        """
+        if self._pending and len(sys.modules) != self._modulesSeen:
+            self._install()
+        if self.sampleInterval:
+            self._startSampler()
+        _active[thread.get_ident()] = [metric, self.budget]
+
+    def stop(self, metric):
+        """
+        The request of the metric has finished
+        """
+        ident = thread.get_ident()
+        active = _active.get(ident)
+        if active is not None and active[0] is metric:
+            del _active[ident]
+            return
+        # the response was closed on another thread
+        for ident, active in _active.items():
+            if active[0] is metric:
+                _active.pop(ident, None)
+
+    def _install(self):
+        # another thread is installing the hooks, the next request will check
+        if not self._installLock.acquire(False):
+            return
+        try:
+            modulesSeen = len(sys.modules)
+            pending = []
+            for hook in self._pending:
+                moduleName, className, attribute, name = hook
+                module = sys.modules.get(moduleName)
+                if module is None:
+                    pending.append(hook)
+                    continue
+                # the module may still be importing on another thread,
+                # look again on the next request
+                owner = getattr(module, className, None)
+                if owner is None:
+                    pending.append(hook)
+                    modulesSeen = None
+                    continue
+                if instrument(owner, attribute, name):
+                    self.log("Instrumented %s.%s.%s", moduleName, className, attribute)
+            self._pending = pending
+            self._modulesSeen = modulesSeen
+        finally:
+            self._installLock.release()
+
+    def _startSampler(self):
+        # started by the first request, the sampler of a pre-fork
+        # master does not survive in its workers
+        sampler = Instrumentation._sampler
+        if sampler is None or sampler.pid != os.getpid() or not sampler.isAlive():
+            sampler = _Sampler(self.sampleInterval)
+            sampler.daemon = True
+            sampler.start()
+            Instrumentation._sampler = sampler
+
+
+def _libraryPaths():
+    """
+    The directories of the standard library, the installed packages and
+    graphdat itself, the sampler looks past the code in them
+    """
+    from distutils import sysconfig
+    paths = [os.path.dirname(os.__file__),
+             sysconfig.get_python_lib(standard_lib=True),
+             sysconfig.get_python_lib(),
+             os.path.dirname(__file__)]
+    return tuple(set(os.path.join(os.path.abspath(path), '') for path in paths))
+
+
+class _Sampler(threading.Thread):
+
+    """
+    Create a separate thread that looks at the instrumented requests
+    and attributes the time between looks to the line of the application
+    they are running, the first one outside of the standard library and
+    the installed packages
+    """
+
+    def __init__(self, interval):
+
+        threading.Thread.__init__(self)
+
+        self.interval = interval
+        self.pid = os.getpid()
+
+        # the library directories, and the files we know are in them
+        self.libraryPaths = _libraryPaths()
+        self._isLibrary = {}
+
+        # set when the interpreter exits
+        self.exiting = exiting
+
+    def run(self):
+        # the modules we use are torn down while the interpreter exits,
+        # stop quietly instead of failing with them
+        try:
+            while not self.exiting:
+                time.sleep(self.interval)
+                if _active:
+                    self.sample()
+        except:
+            # even the builtins are gone by then, catch everything
+            if not self.exiting:
+                raise
+
+    def sample(self):
+        """
+        Add the interval to the line each instrumented request is running
+        """
+        elapsed = self.interval * 1000  # need it in milliseconds
+        frames = sys._current_frames()
+        for ident, active in _active.items():
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            frame = self._applicationFrame(frame)
+            code = frame.f_code
+            site = (code.co_filename, frame.f_lineno, code.co_name)
+
+            metric = active[0]
+            if metric.samples is None:
+                metric.samples = {}
+            metric.samples[site] = metric.samples.get(site, 0) + elapsed
+
+        # do not keep the frames of the requests alive
+        frame = frames = None
+
+    def _applicationFrame(self, frame):
+        # walk out of the library calls to the application code that made
+        # them, or keep the innermost frame if it is all library code
+        caller = frame
+        while caller is not None:
+            filename = caller.f_code.co_filename
+            isLibrary = self._isLibrary.get(filename)
+            if isLibrary is None:
+                isLibrary = self._isLibrary[filename] = \
+                    os.path.abspath(filename).startswith(self.libraryPaths)
+            if not isLibrary:
+                return caller
+            caller = caller.f_back
+        return frame
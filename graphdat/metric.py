@@ -1,14 +1,25 @@
 import os
 import time
 from dotdictionary import DotDictionary
+from extractors import StringCache
+
+# the C version of the timer path, it is optional, see setup.py
+try:
+    import _speedups
+except ImportError:
+    _speedups = None
 
 __all__ = ['Metric']
 
-# pid of the process we are running, automatically added to the metrics
-try:
-    PID = os.getpid()
-except:
-    PID = 0
+def getPid():
+    """
+    pid of the process we are running, automatically added to the metrics.
+    It is not cached, a pre-fork server imports us before forking its workers
+    """
+    try:
+        return os.getpid()
+    except:
+        return 0
 
 class Metric(object):
     """
@@ -25,6 +36,16 @@ class Metric(object):
         "source": "HTTP",
         "timestamp": 1353535694666.753,
         "type": "Sample",
+        "status": 200,
+        "size": 1024,
+        "tags": {
+            "user-agent": "curl/7.24.0"
+        },
+        "error": False,
+        "samples": [{
+             "name": "app/models.py:42 (query)",
+             "responsetime": 20
+        }],
         "context": [{
              "callcount": 1,
              "cputime": 49.635,
@@ -43,17 +64,37 @@ class Metric(object):
 
     # the depth of children a timer is allowed to have
     MAXIMUM_DEPTH = 50
+    # the number of call sites from the sampler we send, slowest first
+    MAXIMUM_SAMPLES = 20
+    # the tag values msgpack can send as they are, anything else is sent as a string
+    TAG_TYPES = (basestring, bool, int, long, float)
     # the starting point for a timer
     ROOT_REQUEST = "/"
+    # the status we report when the application raised before starting the response
+    ERROR_STATUS = 500
     # keys that need to be in the request for a valid metric
     REQUEST_KEYS = ("HTTP_HOST", "REQUEST_METHOD", "PATH_INFO")
 
-    def __init__(self, request, regexRoutes, infoLogger, errorLogger):
+    def __init__(self, request, regexRoutes, infoLogger, errorLogger,
+                 extractors=(), cache=None):
         self.request = request
         self.regexRoutes = regexRoutes
         self.log = infoLogger
         self.error = errorLogger
 
+        # the (tag, extractor) pairs used to enrich the payload
+        self.extractors = extractors
+        # host and route strings are shared between requests
+        self.cache = cache or StringCache()
+
+        # the status line and size of the response, set by the wrapper
+        self.status = None
+        self.responseSize = None
+        # the exception type if the application failed, set by the wrapper
+        self.exception = None
+        # the time spent on each call site, set by the sampler
+        self.samples = None
+
         # we measure the offsets of the subsequent timers
         # off the request start time
         self.requestStart = time.time()
@@ -77,6 +118,9 @@ class Metric(object):
             self.log("Timer can not be started, name is missing")
             return
 
+        # the C version only begins the timers we already have
+        if _speedups is not None and _speedups.beginTimer(self, name):
+            return
         self._beginTimer(name)
 
     def end(self, name):
@@ -87,7 +131,10 @@ class Metric(object):
             self.log("Timer can not be ended, name is missing")
             return
 
-        self._endTimer(name)
+        if _speedups is not None:
+            _speedups.endTimer(self, name)
+        else:
+            self._endTimer(name)
 
     def compile(self):
         """
@@ -104,63 +151,100 @@ class Metric(object):
         payload = DotDictionary({
             'context': context,
             'host': self._getRequestHost(),
-            'pid': PID,
+            'pid': getPid(),
             'responsetime': context[0].responsetime,
-            'route': self._getRequestMethod() + ' ' + self._getRequestPath(),
+            'route': self._getRequestRoute(),
             'source': 'HTTP',
             'timestamp': self.requestStart,
             'type': 'Sample',
         })
 
-        self.log('Request %s took %f' % (payload.route, payload.responsetime))
+        status = self._getStatusCode()
+        if status is None and self.exception is not None:
+            status = self.ERROR_STATUS
+        if status is not None:
+            payload.status = status
+        payload.error = self._isError(status)
+        if self.exception is not None:
+            payload.exception = self.exception.__name__
+        if self.responseSize is not None:
+            payload.size = self.responseSize
+
+        tags = self._getTags()
+        if tags:
+            payload.tags = tags
+
+        if self.samples:
+            payload.samples = self._compileSamples()
+
+        self.log('Request %s took %f', payload.route, payload.responsetime)
         return [payload]
 
     def _beginTimer(self, name):
 
-        separator = (self.current and self.current.path[-1] != '/') and '/' or ''
-        path = (self.current) and self.current.path + separator + name or name
+        # a timer is cached on its parent by name, so a timer that is
+        # called again (per row timers in a loop) does not rebuild its path
+        now = time.time()
+        current = self.current
+        if current is not None:
+            timer = current.childrenByName.get(name)
+        else:
+            timer = self.routes.get(name)
+
+        if timer is None:
+            timer = self._createTimer(name, current, now)
+            if timer is None:
+                return
+
+        self.log("Starting timer for path %s", timer.path)
+
+        # increment the counter and reset the timer in case we have the same
+        # path twice, otherwise the numbers will get skewed
+        timer.callcount += 1
+        timer.lastTimerStart = now
+        self.current = timer
+
+    def _createTimer(self, name, parent, now):
+
+        separator = (parent and parent.path[-1] != '/') and '/' or ''
+        path = (parent) and parent.path + separator + name or name
 
         depth = path.count('/')
         if (depth > self.MAXIMUM_DEPTH):
             # sometimes some code ends up in a recursive loop, lets not create timers for each one of those accidents
-            self.error("The timer stack is too deep.  The current hierarchy is %d levels deep, maximum depth is %d", (depth, self.MAXIMUM_DEPTH))
-            return
-
-        self.log("Starting timer for path %s" % path)
+            self.error("The timer stack is too deep.  The current hierarchy is %d levels deep, maximum depth is %d", depth, self.MAXIMUM_DEPTH)
+            return None
 
         # if we have a route for this, get it, otherwise create a new one
-        if path in self.routes:
-            timer = self.routes[path]
-        else:
-            offset = time.time() - self.requestStart
-            timer = Timer(name, offset, path, self.current)
+        timer = self.routes.get(path)
+        if timer is None:
+            timer = Timer(name, now - self.requestStart, path, parent)
             self.routes[path] = timer
-            if (self.current):
-                self.current.children.append(timer)
+            if (parent):
+                parent.children.append(timer)
 
-        # increment the counter and reset the timer in case we have the same
-        # path twice, otherwise the numbers will get skewed
-        timer.callcount += 1
-        timer.lastTimerStart = time.time()
-        self.current = timer
+        if (parent):
+            parent.childrenByName[name] = timer
+        return timer
 
     def _endTimer(self, name):
 
-        if len(self.routes) == 0:
-            self.log('timers :: trying to end timer %s when there are no timers' % name)
+        current = self.current
+        if not self.routes:
+            self.log('timers :: trying to end timer %s when there are no timers', name)
             return False
-        if self.current is None:
-            self.log('timers :: trying to end timer %s when current is none' % name)
+        if current is None:
+            self.log('timers :: trying to end timer %s when current is none', name)
             return False
-        if self.current.name != name:
-            self.log('timers :: could not end timer %s because it is not the last timer to begin' % name)
+        if current.name != name:
+            self.log('timers :: could not end timer %s because it is not the last timer to begin', name)
             return False
 
-        duration = (time.time() - self.current.lastTimerStart) * 1000  # need it in milliseconds
-        self.current.responseTime += duration
+        duration = (time.time() - current.lastTimerStart) * 1000  # need it in milliseconds
+        current.responseTime += duration
 
-        self.log("Ending timer for path %s" % self.current.path)
-        self.current = self.current.parent
+        self.log("Ending timer for path %s", current.path)
+        self.current = current.parent
         return True
 
     def _endAllTimers(self):
@@ -181,16 +265,64 @@ class Metric(object):
         __compileTimers(root)
         return metrics
 
-    def _getRequestMethod(self):
-        return self.request['REQUEST_METHOD']
+    def _compileSamples(self):
+        # items() is a copy, the sampler may still be adding to it
+        samples = sorted(self.samples.items(), key=lambda sample: sample[1], reverse=True)
+        result = []
+        for (filename, lineno, function), responseTime in samples[:self.MAXIMUM_SAMPLES]:
+            sample = DotDictionary()
+            sample.name = '%s:%d (%s)' % (filename, lineno, function)
+            sample.responsetime = responseTime
+            result.append(sample)
+        return result
+
+    def _getStatusCode(self):
+        # the status line looks like '200 OK'
+        try:
+            return int(self.status[:3])
+        except (TypeError, ValueError):
+            return None
+
+    def _isError(self, status):
+        # server errors and exceptions count against the route,
+        # client errors (4xx) are the callers problem
+        return self.exception is not None or (status is not None and status >= 500)
+
+    def _getTags(self):
+        tags = {}
+        for name, extract in self.extractors:
+            try:
+                value = extract(self.request)
+                if value is None:
+                    continue
+                # a value we can not pack would stop the metrics being sent
+                if not isinstance(value, self.TAG_TYPES):
+                    value = str(value)
+            except Exception, msg:
+                self.error(msg)
+                continue
+            tags[name] = value
+        return tags
 
     def _getRequestHost(self):
-        return self.request['HTTP_HOST'].split(':')[0]
+        host = self.request.get('HTTP_HOST') or self.request.get('SERVER_NAME', '')
+        return self.cache.get(host, self._buildRequestHost)
 
-    def _getRequestPath(self):
-        path = self.request["PATH_INFO"]
-        query_sep = self.request["QUERY_STRING"] and '?' or ''
-        query = self.request["QUERY_STRING"]
+    def _buildRequestHost(self, host):
+        return host.split(':')[0]
+
+    def _getRequestRoute(self):
+        key = (self.request.get('REQUEST_METHOD', ''),
+               self.request.get('PATH_INFO', ''),
+               self.request.get('QUERY_STRING', ''))
+        return self.cache.get(key, self._buildRequestRoute)
+
+    def _buildRequestRoute(self, key):
+        method, path, query = key
+        return method + ' ' + self._getRequestPath(path, query)
+
+    def _getRequestPath(self, path, query):
+        query_sep = query and '?' or ''
         uri = '%s%s%s' % (path, query_sep, query)
 
         if (self.regexRoutes):
@@ -232,6 +364,10 @@ class Timer(object):
     code is spending the most amount of time
     """
 
+    # a request can create a lot of timers, keep them small
+    __slots__ = ('name', 'offset', 'path', 'parent', 'children',
+                 'childrenByName', 'callcount', 'lastTimerStart', 'responseTime')
+
     def __init__(self, name, offset, path, parent):
         # name of the timer ex. bar
         self.name = name
@@ -243,6 +379,8 @@ class Timer(object):
         # up the tree to close timers if needed.
         self.parent = parent
         self.children = []
+        # the children by their name so we can find them without the path
+        self.childrenByName = {}
         # how many times this timer was called
         self.callcount = 0
         # when was the timer was started
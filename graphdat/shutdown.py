@@ -0,0 +1,14 @@
+import atexit
+
+__all__ = ['exiting']
+
+# not empty once the interpreter is exiting, the daemon threads keep a
+# reference to it so they can stop quietly while the modules they use
+# are torn down, instead of printing the errors they cause
+exiting = []
+
+
+def _onExit():
+    exiting.append(True)
+
+atexit.register(_onExit)
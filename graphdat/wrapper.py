@@ -1,10 +1,11 @@
 import functools
-import logging
+import os
 import re
 import sys
+import thread
 
-from agent import Agent
 from dotdictionary import DotDictionary
+from extractors import StringCache, compileExtractors
 from metric import Metric
 
 __all__ = ['WSGIWrapper', 'wsgi_application', 'wrap_wsgi_application']
@@ -29,6 +30,31 @@ class WSGIWrapper(object):
 
     Adding in a list of route regexs in the options willl allow graphdat to
     tokenize urls making the resulting data more generic
+
+    Adding a list of request headers or a dictionary of tags in the options
+    will add them to the metrics so you can slice the dashboards by them
+
+    Setting summaries in the options sends a Summary message for each route
+    every 10 seconds, with the count and the totalresponsetime of the
+    successful requests and the errorcount and errortotalresponsetime of
+    the failed ones.  The response times are totals in milliseconds, not
+    averages.  Summaries are always sent with exemplars and with the merge
+    overflow policy
+
+    Setting exemplars in the options will only send a summary of each route,
+    with the full timers of the slowest requests and the requests over the
+    slowThreshold (or the slowRoutes threshold for the route)
+
+    The queueSize, queueBytes and overflow options control how much is
+    buffered for the agent and what happens when the buffer is full.  With
+    queueBytes each sample is packed on the request thread to measure it,
+    the packed sample is what gets sent so it is only packed once.  The
+    errors and exemplars have a lane of their own, priorityQueueSize
+    samples long
+
+    Setting instrument in the options adds timers for the database, http,
+    socket and template calls, and setting sampler shows the lines of code
+    the requests spend their time on
     """
 
     def __init__(self, app, options=None):
@@ -45,6 +71,17 @@ class WSGIWrapper(object):
                 else:
                     self.routes.append(regex)
 
+        # the extractors that add tags to the metrics
+        self.extractors = compileExtractors(options)
+        # the host and route strings shared between requests
+        self.cache = StringCache()
+
+        # the automatic timers and the sampler, only loaded if we use them
+        self.instrumentation = None
+        if options is not None and (options.get('instrument') or options.get('sampler')):
+            from instrument import Instrumentation
+            self.instrumentation = Instrumentation(options, self.graphdat)
+
         # wrap the application
         self.log('wrapping application')
         functools.update_wrapper(self, app, self._available_attrs(app))
@@ -53,12 +90,26 @@ class WSGIWrapper(object):
     def __call__(self, environ, start_response):
 
         # add graphdat to the request so you can call the begin & end methods
-        self._onRequestStart(environ)
+        metric = self._onRequestStart(environ)['graphdat']
+
+        # keep the status of the response and the error if there was one
+        def _start_response(status, headers, exc_info=None):
+            metric.status = status
+            if exc_info:
+                metric.exception = exc_info[0]
+            write = start_response(status, headers, exc_info)
+
+            # the bytes written before the iterable count towards the size
+            def _write(data):
+                metric.responseSize = (metric.responseSize or 0) + len(data)
+                return write(data)
+            return _write
 
         try:
-            result = self.wrapped(environ, start_response)
+            result = self.wrapped(environ, _start_response)
         except BaseException, e:
             self.graphdat.error(e)
+            metric.exception = sys.exc_info()[0]
             self._onRequestEnd(environ)
             raise
 
@@ -66,8 +117,11 @@ class WSGIWrapper(object):
         return Iterable(self._onRequestStart, self._onRequestEnd, environ, result)
 
     def _onRequestStart(self, request):
-        metric = Metric(request, self.routes, self.graphdat.log, self.graphdat.error)
+        metric = Metric(request, self.routes, self.graphdat.log, self.graphdat.error,
+                        self.extractors, self.cache)
         request['graphdat'] = metric
+        if self.instrumentation is not None:
+            self.instrumentation.start(metric)
         return request
 
     def _onRequestEnd(self, request):
@@ -78,6 +132,8 @@ class WSGIWrapper(object):
 
         # compile the metrics of the request and send them to graphdat
         metric = request['graphdat']
+        if self.instrumentation is not None:
+            self.instrumentation.stop(metric)
         data = metric.compile()
         if data is not None:
             self.graphdat.add(data)
@@ -94,31 +150,51 @@ class Iterable(object):
         self.end = end
         self.environ = environ
         self.generator = generator
+        # the number of bytes sent in the response
+        self.size = 0
 
     def __iter__(self):
         #if not 'graphdat' in self.environ:
         #    self.start(self.environ)
 
-        for item in self.generator:
-            yield item
+        try:
+            for item in self.generator:
+                self.size += len(item)
+                yield item
+        except Exception:
+            # the application failed while sending the response
+            metric = self.environ.get('graphdat')
+            if metric is not None:
+                metric.exception = sys.exc_info()[0]
+            raise
 
     def close(self):
         try:
             if hasattr(self.generator, 'close'):
                 self.generator.close()
         finally:
+            # keep the size of the response
+            metric = self.environ.get('graphdat')
+            if metric is not None:
+                metric.responseSize = (metric.responseSize or 0) + self.size
             self.end(self.environ)
 
 class Graphdat(object):
 
     """
     Graphat configuration
+
+    Nothing is started until the first request is sent to graphdat, the
+    logging is set up, the agent threads are started and the transport is
+    opened then.  This keeps the import and the wrapping of the application
+    fast, and safe to do in a pre-fork master process.
     """
 
     HOST = 'localhost'
     PORT = 26873
     SOCKET_FILE = '/tmp/gd.agent.sock'
     VERSION = '2.3'
+    OVERFLOW_POLICIES = ('drop-newest', 'drop-oldest', 'merge', 'block')
 
     def __init__(self, options):
 
@@ -143,15 +219,39 @@ class Graphdat(object):
         else:
             self.messageDump = False
 
-        # should graphdat use a preconfigured logger
-        self._log = DotDictionary()
-        if options.logger:
-            self._log.error = options.logger.error
-            self._log.info = options.logger.info
+        # should graphdat only send summaries and the slowest requests
+        if 'exemplars' in options:
+            self.exemplars = bool(options.exemplars)
+        else:
+            self.exemplars = False
+        self.exemplarCount = options.exemplarCount
+        self.slowThreshold = options.slowThreshold
+        self.slowRoutes = options.slowRoutes or {}
+
+        # how many samples (or bytes) we buffer for the agent and what
+        # we do with the next sample once the buffer is full
+        self.queueSize = options.queueSize
+        self.queueBytes = options.queueBytes
+        self.queueTimeout = options.queueTimeout
+        self.priorityQueueSize = options.priorityQueueSize
+        self.overflow = options.overflow
+        if self.overflow is not None and self.overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(
+                "the overflow option should be one of %s" % ', '.join(self.OVERFLOW_POLICIES))
+
+        # should graphdat send a summary of each route, the exemplars and
+        # the merged samples are sent with the summaries so they need them
+        if 'summaries' in options:
+            self.summaries = bool(options.summaries)
         else:
-            logging.basicConfig(level='INFO')
-            self._log.error = logging.error
-            self._log.info = logging.info
+            self.summaries = False
+        if self.exemplars or self.overflow == 'merge':
+            self.summaries = True
+
+        # should graphdat use a preconfigured logger, otherwise logging
+        # is set up the first time we have something to log
+        self.logger = options.logger
+        self._log = None
 
         # UDP for Windows and File Socket for Linux
         if sys.platform == 'win32':
@@ -162,8 +262,11 @@ class Graphdat(object):
 
         self.log("Graphdat (v%s) is %s" % (self.VERSION, self.enabled and 'enabled' or 'disabled'))
 
-        # Create the agent so we can start collecting metrics
-        self.agent = Agent(self)
+        # The agent is created on the first request, in the process that
+        # handles the request
+        self.agent = None
+        self.agentPid = None
+        self._agentLock = thread.allocate_lock()
 
         if self.debug:
             self.log('Graphdat is running in debug mode')
@@ -178,16 +281,59 @@ class Graphdat(object):
             return self.socketHost + ':' + str(self.socketPort)
 
     def add(self, metrics):
-        self.agent.add(metrics)
+        # a disabled graphdat does not start the agent or send anything
+        if not self.enabled:
+            return
+        agent = self._getAgent()
+        if agent is not None:
+            agent.add(metrics)
 
     def log(self, msg, *args, **kwargs):
         if self.debug:
-            self._log.info(msg, *args, **kwargs)
+            self._getLog().info(msg, *args, **kwargs)
 
     def error(self, msg, *args, **kwargs):
         if self.debug:
-            self._log.error(msg)
+            self._getLog().error(msg, *args, **kwargs)
 
     def dump(self, msg, *args, **kwargs):
         if self.messageDump:
-            self._log.info(msg, *args, **kwargs)
+            self._getLog().info(msg, *args, **kwargs)
+
+    def _getAgent(self):
+        # a forked worker does not have the threads of its parent,
+        # so it needs an agent of its own
+        pid = os.getpid()
+        if self.agentPid != pid:
+            self._agentLock.acquire()
+            try:
+                if self.agentPid != pid:
+                    self.agent = self._createAgent()
+                    self.agentPid = pid
+            finally:
+                self._agentLock.release()
+        return self.agent
+
+    def _createAgent(self):
+        # if the agent can not start (msgpack is missing) the requests
+        # should not fail because of it, say so once and send nothing
+        try:
+            from agent import Agent
+            return Agent(self)
+        except Exception, e:
+            self._getLog().error("Graphdat could not start, no metrics will be sent: %s", e)
+            return None
+
+    def _getLog(self):
+        if self._log is None:
+            log = DotDictionary()
+            if self.logger:
+                log.error = self.logger.error
+                log.info = self.logger.info
+            else:
+                import logging
+                logging.basicConfig(level='INFO')
+                log.error = logging.error
+                log.info = logging.info
+            self._log = log
+        return self._log
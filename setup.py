@@ -1,7 +1,37 @@
+import sys
+from distutils.command.build_ext import build_ext
+from distutils.errors import CCompilerError, DistutilsExecError, DistutilsPlatformError
+
 try:
-    from setuptools import setup
+    from setuptools import setup, Extension
 except:
-    from distutils.core import setup
+    from distutils.core import setup, Extension
+
+
+class optional_build_ext(build_ext):
+
+    """
+    The C speedups are optional, when they can not be built (no compiler,
+    no Python headers) graphdat is installed without them and uses the
+    Python version of the timer path
+    """
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except DistutilsPlatformError, e:
+            self._unavailable(e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsExecError, DistutilsPlatformError, IOError), e:
+            self._unavailable(e)
+
+    def _unavailable(self, e):
+        sys.stderr.write("WARNING: the graphdat C speedups could not be built, "
+                         "the Python version is used instead (%s)\n" % e)
+
 
 setup(
     name='graphdat',
@@ -9,6 +39,8 @@ setup(
     author='Graphdat',
     author_email='support@graphdat.com',
     packages=['graphdat'],
+    ext_modules=[Extension('graphdat._speedups', ['graphdat/_speedups.c'])],
+    cmdclass={'build_ext': optional_build_ext},
     url='http:/www.graphdat.com',
     license='Apache License 2.0',
     description='Graphdat instrumentation module',
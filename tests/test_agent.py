@@ -0,0 +1,168 @@
+import unittest
+
+from graphdat.agent import _HEARTBEAT, Agent, _LaneQueue
+from graphdat.aggregate import Aggregator
+from graphdat.dotdictionary import DotDictionary
+
+
+def drain(queue):
+    messages = []
+    while True:
+        message = queue.get(0)
+        if message is None:
+            return messages
+        messages.append(message)
+
+
+class LaneQueueTest(unittest.TestCase):
+
+    def test_drop_newest(self):
+        queue = _LaneQueue()
+        queue.configure(3, None, _LaneQueue.DROP_NEWEST)
+        self.assertEqual([queue.put(i) for i in range(5)], [True, True, True, False, False])
+        self.assertEqual(drain(queue), [0, 1, 2])
+
+    def test_drop_oldest(self):
+        queue = _LaneQueue()
+        queue.configure(3, None, _LaneQueue.DROP_OLDEST)
+        self.assertEqual([queue.put(i) for i in range(5)], [True] * 5)
+        self.assertEqual(drain(queue), [2, 3, 4])
+
+    def test_drop_oldest_message_larger_than_the_lane(self):
+        queue = _LaneQueue()
+        queue.configure(10, 100, _LaneQueue.DROP_OLDEST)
+        for i in range(5):
+            self.assertTrue(queue.put(i, 10))
+        self.assertFalse(queue.put('large', 500))
+        self.assertEqual(len(queue.routine), 5)
+        self.assertEqual(queue.routineBytes, 50)
+
+    def test_bytes(self):
+        queue = _LaneQueue()
+        queue.configure(100, 10)
+        self.assertEqual([queue.put('x', 4) for i in range(3)], [True, True, False])
+        self.assertEqual(queue.routineBytes, 8)
+
+    def test_block_without_a_timeout(self):
+        queue = _LaneQueue()
+        queue.configure(1, None, _LaneQueue.BLOCK, 0)
+        self.assertTrue(queue.put('first'))
+        self.assertFalse(queue.put('second'))
+        self.assertEqual(drain(queue), ['first'])
+
+    def test_priority_size(self):
+        queue = _LaneQueue()
+        queue.configure(100, maxPrioritySize=2)
+        self.assertEqual([queue.put(i, priority=True) for i in range(3)], [True, True, False])
+        self.assertTrue(queue.put('sample'))
+
+    def test_priority_first(self):
+        queue = _LaneQueue()
+        queue.put('sample')
+        queue.put('error', priority=True)
+        self.assertEqual(drain(queue), ['error', 'sample'])
+
+    def test_heartbeat_with_a_full_priority_lane(self):
+        queue = _LaneQueue()
+        for i in range(_LaneQueue.MAX_PRIORITY_SIZE):
+            self.assertTrue(queue.put('error', priority=True))
+        self.assertFalse(queue.put('error', priority=True))
+        queue.putHeartbeat()
+        queue.putHeartbeat()
+        messages = drain(queue)
+        self.assertTrue(messages[0] is _HEARTBEAT)
+        self.assertEqual(messages.count(_HEARTBEAT), 1)
+        self.assertEqual(len(messages), _LaneQueue.MAX_PRIORITY_SIZE + 1)
+
+
+def _noop(*args, **kwargs):
+    pass
+
+
+def sample(responsetime, error=False, route='GET /'):
+    return DotDictionary({'host': 'localhost', 'route': route, 'responsetime': responsetime,
+                          'error': error, 'source': 'HTTP', 'type': 'Sample'})
+
+
+def newAgent(**options):
+    """
+    An agent with a queue and aggregator of its own, without the sender
+    """
+    graphdat = DotDictionary({'exemplars': False, 'summaries': False, 'log': _noop})
+    graphdat.update(options)
+    agent = Agent.__new__(Agent)
+    agent.graphdat = graphdat
+    agent.log = _noop
+    agent._queue = _LaneQueue()
+    agent._aggregator = Aggregator()
+    return agent
+
+
+class ExemplarAgentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.agent = newAgent(exemplars=True, summaries=True)
+        self.agent._aggregator.configure(slowThreshold=100)
+
+    def test_fast_successes_are_only_kept_as_exemplars(self):
+        self.agent.add([sample(10), sample(20)])
+        self.assertEqual(drain(self.agent._queue), [])
+        stats = self.agent._aggregator.routes[('localhost', 'GET /')]
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(len(stats.exemplars), 2)
+
+    def test_slow_requests_are_sent(self):
+        self.agent.add([sample(500)])
+        self.assertEqual(len(self.agent._queue.priority), 1)
+        messages = drain(self.agent._queue)
+        self.assertEqual(messages[0].type, 'Exemplar')
+        stats = self.agent._aggregator.routes[('localhost', 'GET /')]
+        self.assertEqual((stats.count, stats.exemplars), (1, []))
+
+    def test_errors_are_sent(self):
+        self.agent.add([sample(10, error=True)])
+        self.assertEqual(len(self.agent._queue.priority), 1)
+        self.assertEqual(drain(self.agent._queue)[0].type, 'Exemplar')
+        self.assertEqual(self.agent._aggregator.routes[('localhost', 'GET /')].errors, 1)
+
+
+class AgentTest(unittest.TestCase):
+
+    def test_errors_go_in_the_priority_lane(self):
+        agent = newAgent()
+        agent.add([sample(10), sample(10, error=True)])
+        self.assertEqual(len(agent._queue.priority), 1)
+        self.assertEqual(len(agent._queue.routine), 1)
+        self.assertTrue(drain(agent._queue)[0].error)
+
+    def test_no_summaries(self):
+        agent = newAgent()
+        agent.add([sample(10)])
+        self.assertEqual(agent._aggregator.routes, {})
+
+    def test_merged_when_full(self):
+        agent = newAgent(summaries=True)
+        agent._queue.configure(1, None, _LaneQueue.MERGE)
+        agent.add([sample(10), sample(20)])
+        self.assertEqual(len(agent._queue.routine), 1)
+        stats = agent._aggregator.routes[('localhost', 'GET /')]
+        self.assertEqual((stats.count, stats.merged), (2, 1))
+
+    def test_dropped_when_full(self):
+        agent = newAgent(summaries=True)
+        agent._queue.configure(1, None, _LaneQueue.DROP_NEWEST)
+        agent.add([sample(10), sample(20)])
+        self.assertEqual(agent._aggregator.routes[('localhost', 'GET /')].merged, 0)
+
+    def test_packed_to_measure_the_bytes(self):
+        agent = newAgent()
+        agent._queue.configure(100, 1000)
+        agent.add([sample(10)])
+        message, size = agent._queue.routine[0]
+        self.assertTrue(isinstance(message, str))
+        self.assertEqual(size, len(message))
+        self.assertEqual(agent._queue.routineBytes, size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import re
+import unittest
+
+from graphdat.aggregate import Aggregator, RouteStats
+from graphdat.dotdictionary import DotDictionary
+from graphdat.metric import Metric
+
+
+def _noop(*args, **kwargs):
+    pass
+
+
+def sample(path, routes=()):
+    environ = {'HTTP_HOST': 'localhost', 'REQUEST_METHOD': 'GET', 'PATH_INFO': path}
+    payload = Metric(environ, list(routes), _noop, _noop).compile()[0]
+    # every request is slow
+    payload.responsetime = 500
+    return payload
+
+
+class SlowRoutesTest(unittest.TestCase):
+
+    def test_regex_route(self):
+        aggregator = Aggregator()
+        aggregator.configure(slowRoutes={'GET users/:id': 250})
+        metric = sample('/users/42', [re.compile(r'users/(?P<id>\d+)')])
+        self.assertEqual(metric.route, 'GET users/:id')
+        self.assertTrue(aggregator.isSlow(metric))
+
+    def test_route_without_regex(self):
+        aggregator = Aggregator()
+        aggregator.configure(slowRoutes={'GET /users/42': 250})
+        self.assertTrue(aggregator.isSlow(sample('/users/42')))
+        self.assertFalse(aggregator.isSlow(sample('/users/43')))
+
+
+class _Incomparable(DotDictionary):
+    # the samples should never be compared to each other
+    def __cmp__(self, other):
+        raise AssertionError('the samples were compared')
+    __lt__ = __le__ = __gt__ = __ge__ = __eq__ = __ne__ = __cmp__
+    __hash__ = object.__hash__
+
+
+def timed(responsetime, error=False):
+    return _Incomparable({'host': 'localhost', 'route': 'GET /', 'responsetime': responsetime,
+                          'error': error, 'type': 'Sample'})
+
+
+class ExemplarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.aggregator = Aggregator()
+        self.aggregator.configure(exemplarCount=3)
+
+    def exemplars(self):
+        return [message for message in self.aggregator.flush() if message.type == 'Exemplar']
+
+    def test_keeps_the_slowest_slowest_first(self):
+        for responsetime in (5, 50, 1, 30, 40, 2, 10):
+            self.aggregator.add(timed(responsetime), keepExemplar=True)
+        stats = self.aggregator.routes[('localhost', 'GET /')]
+        self.assertEqual(len(stats.exemplars), 3)
+        self.assertEqual([exemplar.responsetime for exemplar in self.exemplars()], [50, 40, 30])
+
+    def test_bounded(self):
+        for responsetime in range(100):
+            self.aggregator.add(timed(responsetime), keepExemplar=True)
+            self.assertTrue(len(self.aggregator.routes[('localhost', 'GET /')].exemplars) <= 3)
+
+    def test_ties_do_not_compare_the_samples(self):
+        for i in range(10):
+            self.aggregator.add(timed(10), keepExemplar=True)
+        self.assertEqual(len(self.exemplars()), 3)
+
+    def test_only_kept_when_asked(self):
+        self.aggregator.add(timed(10))
+        self.assertEqual(self.exemplars(), [])
+
+
+class FlushTest(unittest.TestCase):
+
+    def test_flush_starts_a_new_window(self):
+        aggregator = Aggregator(interval=60)
+        aggregator.add(timed(10))
+        aggregator.windowStart -= 60
+        self.assertTrue(aggregator.due())
+        self.assertEqual(len(aggregator.flush()), 1)
+
+        self.assertFalse(aggregator.due())
+        self.assertEqual(aggregator.routes, {})
+        self.assertEqual(aggregator.timeLeft(), None)
+        self.assertEqual(aggregator.flush(), [])
+
+    def test_time_left(self):
+        aggregator = Aggregator(interval=60)
+        aggregator.add(timed(10))
+        self.assertTrue(0 < aggregator.timeLeft() <= 60)
+        aggregator.windowStart -= 120
+        self.assertEqual(aggregator.timeLeft(), 0)
+
+
+class RouteStatsTest(unittest.TestCase):
+
+    def test_errors_and_successes_are_kept_apart(self):
+        stats = RouteStats('localhost', 'GET /')
+        for responsetime, error in ((10, False), (20, False), (500, True)):
+            payload = sample('/')
+            payload.responsetime = responsetime
+            payload.error = error
+            stats.add(payload)
+
+        summary = stats.compile(0)
+        self.assertEqual(summary.type, 'Summary')
+        self.assertEqual(summary.count, 2)
+        self.assertEqual(summary.totalresponsetime, 30)
+        self.assertEqual(summary.errorcount, 1)
+        self.assertEqual(summary.errortotalresponsetime, 500)
+        self.assertFalse('responsetime' in summary)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from graphdat.extractors import StringCache, compileExtractors
+
+
+def extract(options, environ):
+    return dict((name, extractor(environ)) for name, extractor in compileExtractors(options))
+
+
+class ExtractorTest(unittest.TestCase):
+
+    def test_headers(self):
+        environ = {
+            'HTTP_USER_AGENT': 'curl',
+            'CONTENT_TYPE': 'text/plain',
+            'CONTENT_LENGTH': '12',
+        }
+        tags = extract({'headers': ['User-Agent', 'Content-Type', 'Content-Length', 'Accept']}, environ)
+        self.assertEqual(tags, {
+            'user-agent': 'curl',
+            'content-type': 'text/plain',
+            'content-length': '12',
+            'accept': None,
+        })
+
+    def test_tags(self):
+        tags = extract({'tags': {'app': 'web', 'method': lambda environ: environ['REQUEST_METHOD']}},
+                       {'REQUEST_METHOD': 'GET'})
+        self.assertEqual(tags, {'app': 'web', 'method': 'GET'})
+
+    def test_no_options(self):
+        self.assertEqual(compileExtractors(None), ())
+
+
+class StringCacheTest(unittest.TestCase):
+
+    def test_built_once(self):
+        built = []
+        def build(key):
+            built.append(key)
+            return ''.join(['GET /', key])
+        cache = StringCache()
+        first = cache.get('users', build)
+        self.assertEqual(first, 'GET /users')
+        self.assertTrue(cache.get('users', build) is first)
+        self.assertEqual(built, ['users'])
+
+    def test_interned(self):
+        cache = StringCache()
+        value = cache.get('users', lambda key: ''.join(['GET /', key]))
+        self.assertTrue(value is intern('GET /users'))
+
+    def test_cleared_when_full(self):
+        cache = StringCache(maxSize=2)
+        for key in ('a', 'b', 'c'):
+            cache.get(key, str.upper)
+        self.assertEqual(cache._cache, {'c': 'C'})
+
+
+if __name__ == '__main__':
+    unittest.main()
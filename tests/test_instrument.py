@@ -0,0 +1,257 @@
+import os
+import socket
+import sys
+import threading
+import types
+import unittest
+
+from graphdat import instrument
+from graphdat.instrument import Instrumentation, _Sampler, _active
+from graphdat.metric import Metric
+
+
+def _noop(*args, **kwargs):
+    pass
+
+
+class _Graphdat(object):
+    log = error = staticmethod(_noop)
+
+
+class _Template(object):
+    def render(self):
+        return 'rendered'
+
+
+class InstrumentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.Template = type('Template', (_Template,), {})
+        self.instrumentation = Instrumentation({'instrumentBudget': 3}, _Graphdat())
+        self.metric = Metric({}, [], _noop, _noop)
+
+    def tearDown(self):
+        self.instrumentation.stop(self.metric)
+
+    def test_missing_attribute(self):
+        self.assertFalse(instrument.instrument(self.Template, 'missing', 'missing'))
+
+    def test_instrument_twice(self):
+        self.assertTrue(instrument.instrument(self.Template, 'render', 'render'))
+        timed = self.Template.__dict__['render']
+        self.assertTrue(instrument.instrument(self.Template, 'render', 'render'))
+        self.assertTrue(self.Template.__dict__['render'] is timed)
+
+    def test_outside_a_request(self):
+        instrument.instrument(self.Template, 'render', 'render')
+        self.assertEqual(self.Template().render(), 'rendered')
+        self.assertFalse('/render' in self.metric.routes)
+
+    def test_inside_a_request(self):
+        instrument.instrument(self.Template, 'render', 'render')
+        self.instrumentation.start(self.metric)
+        self.assertEqual(self.Template().render(), 'rendered')
+        self.assertEqual(self.metric.routes['/render'].callcount, 1)
+        self.assertTrue(self.metric.current is self.metric.routes['/'])
+
+    def test_exception_ends_the_timer(self):
+        def fail(self):
+            raise ValueError('failed')
+        self.Template.fail = fail
+        instrument.instrument(self.Template, 'fail', 'fail')
+        self.instrumentation.start(self.metric)
+        self.assertRaises(ValueError, self.Template().fail)
+        self.assertTrue(self.metric.current is self.metric.routes['/'])
+
+    def test_budget(self):
+        instrument.instrument(self.Template, 'render', 'render')
+        self.instrumentation.start(self.metric)
+        for i in range(5):
+            self.assertEqual(self.Template().render(), 'rendered')
+        self.assertEqual(self.metric.routes['/render'].callcount, 3)
+
+    def test_budget_of_zero(self):
+        instrumentation = Instrumentation({'instrumentBudget': 0}, _Graphdat())
+        instrument.instrument(self.Template, 'render', 'render')
+        instrumentation.start(self.metric)
+        self.assertEqual(self.Template().render(), 'rendered')
+        self.assertFalse('/render' in self.metric.routes)
+
+    def test_socket(self):
+        Socket = type('Socket', (socket.socket,), {})
+        self.assertTrue(instrument.instrument(Socket, 'sendall', 'socket sendall'))
+        left, right = socket.socketpair()
+        sock = Socket(_sock=left)
+        try:
+            self.instrumentation.start(self.metric)
+            sock.sendall('ping')
+            self.assertEqual(right.recv(4), 'ping')
+        finally:
+            sock.close()
+            left.close()
+            right.close()
+        self.assertEqual(self.metric.routes['/socket sendall'].callcount, 1)
+
+    def test_stop(self):
+        self.instrumentation.start(self.metric)
+        self.assertEqual(len(_active), 1)
+        self.instrumentation.stop(self.metric)
+        self.assertEqual(len(_active), 0)
+
+    def test_stop_on_another_thread(self):
+        started = threading.Event()
+        thread = threading.Thread(target=lambda: (self.instrumentation.start(self.metric), started.set()))
+        thread.start()
+        started.wait(5)
+        thread.join(5)
+        self.assertEqual(len(_active), 1)
+        self.instrumentation.stop(self.metric)
+        self.assertEqual(len(_active), 0)
+
+
+def _busy(started, finished):
+    # a list, Event.is_set would be the line we are running half the time
+    started.set()
+    while not finished:
+        pass
+
+
+class SamplerTest(unittest.TestCase):
+
+    def test_samples(self):
+        metric = Metric({}, [], _noop, _noop)
+        instrumentation = Instrumentation({}, _Graphdat())
+        started = threading.Event()
+        finished = []
+
+        def request():
+            instrumentation.start(metric)
+            try:
+                _busy(started, finished)
+            finally:
+                instrumentation.stop(metric)
+
+        thread = threading.Thread(target=request)
+        thread.start()
+        try:
+            started.wait(5)
+            sampler = _Sampler(0.01)
+            for i in range(3):
+                sampler.sample()
+        finally:
+            finished.append(True)
+            thread.join(5)
+
+        self.assertEqual(len(_active), 0)
+        functions = set(function for filename, lineno, function in metric.samples)
+        self.assertEqual(functions, set(['_busy']))
+        self.assertAlmostEqual(sum(metric.samples.values()), 30)
+
+        samples = metric.compile()[0].samples
+        self.assertTrue(samples[0].name.endswith('(_busy)'))
+
+    def test_no_requests(self):
+        _Sampler(0.01).sample()
+
+    def test_library_calls_are_credited_to_the_caller(self):
+        # a busy loop that looks like it is in the standard library
+        library = {}
+        filename = os.path.join(os.path.dirname(os.__file__), 'graphdat_busy.py')
+        exec compile('def busy(finished):\n    while not finished:\n        pass\n',
+                     filename, 'exec') in library
+
+        metric = Metric({}, [], _noop, _noop)
+        instrumentation = Instrumentation({}, _Graphdat())
+        started = threading.Event()
+        finished = []
+
+        def request():
+            instrumentation.start(metric)
+            try:
+                started.set()
+                library['busy'](finished)
+            finally:
+                instrumentation.stop(metric)
+
+        thread = threading.Thread(target=request)
+        thread.start()
+        try:
+            started.wait(5)
+            _Sampler(0.01).sample()
+        finally:
+            finished.append(True)
+            thread.join(5)
+
+        self.assertEqual([function for filename, lineno, function in metric.samples], ['request'])
+
+
+class InstallTest(unittest.TestCase):
+
+    """
+    The hooks are only installed on modules the application imported
+    """
+
+    MODULE = 'graphdat_test_templates'
+
+    def setUp(self):
+        self.hooks = instrument.HOOKS
+        instrument.HOOKS = {'templates': ((self.MODULE, 'Template', 'render', 'template render'),)}
+        sys.modules.pop(self.MODULE, None)
+
+    def tearDown(self):
+        instrument.HOOKS = self.hooks
+        sys.modules.pop(self.MODULE, None)
+
+    def test_hooked_library_is_not_imported(self):
+        instrumentation = Instrumentation({'instrument': True}, _Graphdat())
+        self.assertFalse(self.MODULE in sys.modules)
+        self.assertEqual(len(instrumentation._pending), 1)
+
+    def test_installed_on_the_next_request(self):
+        instrumentation = Instrumentation({'instrument': True}, _Graphdat())
+
+        module = types.ModuleType(self.MODULE)
+        module.Template = type('Template', (_Template,), {})
+        sys.modules[self.MODULE] = module
+
+        metric = Metric({}, [], _noop, _noop)
+        instrumentation.start(metric)
+        try:
+            self.assertEqual(instrumentation._pending, [])
+            self.assertEqual(module.Template().render(), 'rendered')
+        finally:
+            instrumentation.stop(metric)
+        self.assertTrue('/template render' in metric.routes)
+
+    def test_module_still_importing(self):
+        module = sys.modules[self.MODULE] = types.ModuleType(self.MODULE)
+        instrumentation = Instrumentation({'instrument': True}, _Graphdat())
+        self.assertEqual(len(instrumentation._pending), 1)
+
+        # no other module is imported by the time it has finished
+        module.Template = type('Template', (_Template,), {})
+        metric = Metric({}, [], _noop, _noop)
+        instrumentation.start(metric)
+        instrumentation.stop(metric)
+        self.assertEqual(instrumentation._pending, [])
+
+    def test_only_looks_again_after_an_import(self):
+        instrumentation = Instrumentation({'instrument': True}, _Graphdat())
+        installs = []
+        install = instrumentation._install
+        instrumentation._install = lambda: (installs.append(True), install())
+
+        metric = Metric({}, [], _noop, _noop)
+        for i in range(3):
+            instrumentation.start(metric)
+            instrumentation.stop(metric)
+        self.assertEqual(installs, [])
+
+        sys.modules[self.MODULE] = types.ModuleType(self.MODULE)
+        instrumentation.start(metric)
+        instrumentation.stop(metric)
+        self.assertEqual(installs, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
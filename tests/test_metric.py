@@ -0,0 +1,222 @@
+import datetime
+import random
+import unittest
+
+from benchmarks.baseline import BaselineMetric
+from graphdat import metric
+from graphdat.metric import Metric, _speedups
+
+
+def _noop(*args, **kwargs):
+    pass
+
+
+def run(metricClass, operations, speedups=None):
+    """
+    Run the (begin or end, name) operations and return the timers and the
+    log messages, the times are left out as they are never the same
+    between two runs
+    """
+    messages = []
+    def log(msg, *args):
+        messages.append(msg % args)
+
+    saved = metric._speedups
+    metric._speedups = speedups
+    try:
+        sample = metricClass({}, [], log, _noop)
+        for operation, name in operations:
+            getattr(sample, operation)(name)
+        current = sample.current and sample.current.path
+        # compile logs the time the request took
+        logged = messages[:]
+        context = sample.compile()[0].context
+    finally:
+        metric._speedups = saved
+    return current, [(timer.name, timer.callcount) for timer in context], logged
+
+
+class TimerParityTest(unittest.TestCase):
+
+    """
+    The cached timers, in Python and in C, should give the same timers as
+    the baseline that builds the path on every begin
+    """
+
+    def assertParity(self, operations):
+        current, context, messages = run(BaselineMetric, operations)
+        python = run(Metric, operations)
+        self.assertEqual(python[:2], (current, context))
+        if _speedups is not None:
+            # the C version logs the same messages as the Python one
+            self.assertEqual(run(Metric, operations, _speedups), python)
+        return current, context
+
+    def test_nested_timers(self):
+        current, context = self.assertParity([
+            ('begin', 'foo'), ('begin', 'bar'), ('end', 'bar'), ('end', 'foo'),
+            ('begin', 'foo'), ('begin', 'bar'), ('end', 'bar'), ('end', 'foo'),
+        ])
+        self.assertEqual(context, [('/', 1), ('/foo', 2), ('/foo/bar', 2)])
+
+    def test_same_name_twice_in_a_path(self):
+        current, context = self.assertParity([
+            ('begin', 'foo'), ('begin', 'foo'), ('end', 'foo'), ('end', 'foo'),
+            ('begin', 'foo'), ('begin', 'foo'), ('begin', 'bar'),
+        ])
+        self.assertEqual(context, [('/', 1), ('/foo', 2), ('/foo/foo', 2), ('/foo/foo/bar', 1)])
+
+    def test_name_with_a_separator(self):
+        # /foo/bar is the same timer however it was started
+        current, context = self.assertParity([
+            ('begin', 'foo/bar'), ('end', 'foo/bar'),
+            ('begin', 'foo'), ('begin', 'bar'), ('end', 'bar'), ('end', 'foo'),
+            ('begin', 'foo/bar'), ('end', 'foo/bar'),
+        ])
+        names = [name for name, callcount in context]
+        self.assertEqual(names.count('/foo/bar'), 1)
+
+    def test_restart_after_parent_ended(self):
+        current, context = self.assertParity([
+            ('begin', 'foo'), ('begin', 'bar'), ('end', 'bar'), ('end', 'foo'),
+            ('begin', 'bar'), ('end', 'bar'),
+            ('begin', 'foo'), ('begin', 'bar'), ('end', 'bar'), ('end', 'foo'),
+        ])
+        self.assertEqual(context, [('/', 1), ('/foo', 2), ('/foo/bar', 2), ('/bar', 1)])
+
+    def test_restart_after_root_ended(self):
+        current, context = self.assertParity([
+            ('end', '/'), ('begin', 'foo'), ('end', 'foo'),
+            ('begin', '/'), ('begin', 'foo'), ('end', 'foo'),
+        ])
+        self.assertEqual(context, [('/', 2), ('/foo', 1)])
+
+    def test_maximum_depth(self):
+        operations = [('begin', 'foo')] * (Metric.MAXIMUM_DEPTH + 5)
+        current, context = self.assertParity(operations)
+        # the root and a timer for each level
+        self.assertEqual(len(context), Metric.MAXIMUM_DEPTH + 1)
+        self.assertEqual(current.count('/'), Metric.MAXIMUM_DEPTH)
+
+    def test_maximum_depth_then_end(self):
+        operations = [('begin', 'foo')] * (Metric.MAXIMUM_DEPTH + 5)
+        operations += [('end', 'foo')] * 3 + [('begin', 'bar'), ('begin', 'foo')]
+        self.assertParity(operations)
+
+    def test_random_sequence(self):
+        names = ('foo', 'bar', 'baz', 'a/b', '/')
+        for seed in range(5):
+            generator = random.Random(seed)
+            operations = [(generator.choice(('begin', 'begin', 'end')), generator.choice(names))
+                          for i in range(3000)]
+            self.assertParity(operations)
+
+
+@unittest.skipIf(_speedups is None, 'the C speedups are not built')
+class SpeedupsTest(unittest.TestCase):
+
+    def test_begin_only_cached_timers(self):
+        sample = Metric({}, [], _noop, _noop)
+        self.assertFalse(_speedups.beginTimer(sample, 'foo'))
+        self.assertTrue(sample.current is sample.routes['/'])
+        sample._beginTimer('foo')
+        self.assertTrue(_speedups.endTimer(sample, 'foo'))
+        self.assertTrue(_speedups.beginTimer(sample, 'foo'))
+        self.assertEqual(sample.routes['/foo'].callcount, 2)
+        self.assertTrue(sample.current is sample.routes['/foo'])
+
+    def test_end_another_timer(self):
+        sample = Metric({}, [], _noop, _noop)
+        self.assertFalse(_speedups.endTimer(sample, 'foo'))
+        self.assertTrue(sample.current is sample.routes['/'])
+
+    def test_unhashable_name(self):
+        sample = Metric({}, [], _noop, _noop)
+        self.assertRaises(TypeError, sample.begin, ['foo'])
+
+
+class StatusTest(unittest.TestCase):
+
+    def compile(self, status=None, exception=None):
+        metric = Metric({}, [], _noop, _noop)
+        metric.status = status
+        metric.exception = exception
+        return metric.compile()[0]
+
+    def test_success(self):
+        payload = self.compile('200 OK')
+        self.assertEqual(payload.status, 200)
+        self.assertFalse(payload.error)
+
+    def test_client_error_is_not_an_error(self):
+        payload = self.compile('404 Not Found')
+        self.assertEqual(payload.status, 404)
+        self.assertFalse(payload.error)
+
+    def test_server_error(self):
+        payload = self.compile('503 Service Unavailable')
+        self.assertEqual(payload.status, 503)
+        self.assertTrue(payload.error)
+
+    def test_exception_without_a_status(self):
+        payload = self.compile(exception=ValueError)
+        self.assertEqual(payload.status, Metric.ERROR_STATUS)
+        self.assertTrue(payload.error)
+        self.assertEqual(payload.exception, 'ValueError')
+
+    def test_exception_after_the_status(self):
+        payload = self.compile('200 OK', ValueError)
+        self.assertEqual(payload.status, 200)
+        self.assertTrue(payload.error)
+
+
+class RequestTest(unittest.TestCase):
+
+    def compile(self, environ):
+        return Metric(environ, [], _noop, _noop).compile()[0]
+
+    def test_host_and_route(self):
+        payload = self.compile({'HTTP_HOST': 'example.com:8080', 'REQUEST_METHOD': 'GET',
+                                'PATH_INFO': '/users', 'QUERY_STRING': 'page=2'})
+        self.assertEqual(payload.host, 'example.com')
+        self.assertEqual(payload.route, 'GET /users?page=2')
+
+    def test_without_a_host_header(self):
+        payload = self.compile({'SERVER_NAME': 'example.com', 'REQUEST_METHOD': 'GET',
+                                'PATH_INFO': '/users'})
+        self.assertEqual(payload.host, 'example.com')
+
+    def test_without_a_query_string(self):
+        payload = self.compile({'HTTP_HOST': 'example.com', 'REQUEST_METHOD': 'GET',
+                                'PATH_INFO': '/users'})
+        self.assertEqual(payload.route, 'GET /users')
+
+
+class _Unprintable(object):
+    def __str__(self):
+        raise ValueError('unprintable')
+
+
+class TagTest(unittest.TestCase):
+
+    def compileTags(self, tags):
+        extractors = [(name, lambda environ, value=value: value) for name, value in tags.items()]
+        metric = Metric({}, [], _noop, _noop, extractors)
+        return metric.compile()[0].tags
+
+    def test_packable_values(self):
+        tags = {'name': 'web', 'unicode': u'web', 'count': 3, 'big': 2 ** 70,
+                'ratio': 0.5, 'enabled': True}
+        self.assertEqual(self.compileTags(tags), tags)
+
+    def test_other_values_are_strings(self):
+        when = datetime.datetime(2012, 11, 21, 10, 30)
+        tags = self.compileTags({'when': when, 'items': [1, 2]})
+        self.assertEqual(tags, {'when': str(when), 'items': '[1, 2]'})
+
+    def test_missing_and_broken_values_are_dropped(self):
+        self.assertEqual(self.compileTags({'none': None, 'broken': _Unprintable()}), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import sys
+import types
+import unittest
+
+from graphdat.wrapper import WSGIWrapper
+
+
+def _write(data):
+    pass
+
+
+def _start_response(status, headers, exc_info=None):
+    return _write
+
+
+def request(path='/'):
+    return {'HTTP_HOST': 'localhost', 'REQUEST_METHOD': 'GET', 'PATH_INFO': path}
+
+
+class WrapperTest(unittest.TestCase):
+
+    def wrap(self, app):
+        wrapper = WSGIWrapper(app)
+        # keep the samples instead of starting the agent
+        self.samples = []
+        wrapper.graphdat.add = self.samples.extend
+        return wrapper
+
+    def call(self, wrapper, environ=None):
+        result = wrapper(environ or request(), _start_response)
+        try:
+            return ''.join(result)
+        finally:
+            result.close()
+
+    def test_status(self):
+        def app(environ, start_response):
+            start_response('404 Not Found', [])
+            return ['missing']
+        self.assertEqual(self.call(self.wrap(app)), 'missing')
+        self.assertEqual(self.samples[0].status, 404)
+        self.assertFalse(self.samples[0].error)
+        self.assertEqual(self.samples[0].size, 7)
+
+    def test_size_with_write(self):
+        def app(environ, start_response):
+            write = start_response('200 OK', [])
+            write('head')
+            write('er')
+            return ['body']
+        self.assertEqual(self.call(self.wrap(app)), 'body')
+        self.assertEqual(self.samples[0].size, 10)
+
+    def test_exc_info(self):
+        def app(environ, start_response):
+            try:
+                raise ValueError('failed')
+            except ValueError:
+                start_response('500 Internal Server Error', [], sys.exc_info())
+            return ['failed']
+        self.call(self.wrap(app))
+        self.assertEqual(self.samples[0].status, 500)
+        self.assertTrue(self.samples[0].error)
+        self.assertEqual(self.samples[0].exception, 'ValueError')
+
+    def test_exception_while_iterating(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            yield 'partial'
+            raise ValueError('failed')
+        self.assertRaises(ValueError, self.call, self.wrap(app))
+        self.assertEqual(self.samples[0].status, 200)
+        self.assertTrue(self.samples[0].error)
+        self.assertEqual(self.samples[0].exception, 'ValueError')
+        self.assertEqual(self.samples[0].size, 7)
+
+    def test_exception_before_the_response(self):
+        def app(environ, start_response):
+            raise ValueError('failed')
+        self.assertRaises(ValueError, self.call, self.wrap(app))
+        self.assertEqual(self.samples[0].status, 500)
+        self.assertEqual(self.samples[0].exception, 'ValueError')
+
+
+class DisabledTest(unittest.TestCase):
+
+    def test_agent_not_started(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return ['ok']
+        wrapper = WSGIWrapper(app, {'enabled': False})
+        result = wrapper(request(), _start_response)
+        self.assertEqual(''.join(result), 'ok')
+        result.close()
+        self.assertEqual(wrapper.graphdat.agentPid, None)
+
+
+class _Logger(object):
+    def __init__(self):
+        self.errors = []
+
+    def error(self, msg, *args):
+        self.errors.append(msg % args)
+
+    def info(self, msg, *args):
+        pass
+
+
+def _brokenAgent(graphdat):
+    raise ImportError('No module named msgpack')
+
+
+class AgentStartTest(unittest.TestCase):
+
+    MODULE = 'graphdat.agent'
+
+    def setUp(self):
+        self.module = sys.modules.get(self.MODULE)
+        broken = sys.modules[self.MODULE] = types.ModuleType(self.MODULE)
+        broken.Agent = _brokenAgent
+
+    def tearDown(self):
+        if self.module is None:
+            sys.modules.pop(self.MODULE, None)
+        else:
+            sys.modules[self.MODULE] = self.module
+
+    def test_requests_still_work(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return ['ok']
+        logger = _Logger()
+        wrapper = WSGIWrapper(app, {'logger': logger})
+        for i in range(3):
+            result = wrapper(request(), _start_response)
+            self.assertEqual(''.join(result), 'ok')
+            result.close()
+        self.assertEqual(len(logger.errors), 1)
+        self.assertTrue('msgpack' in logger.errors[0])
+
+
+if __name__ == '__main__':
+    unittest.main()